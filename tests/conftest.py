@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import os, sys, asyncio
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# 用tests/stubs中的aiomysql和aiohttp代替真实的包，不需要MySQL
+sys.path.insert(0, os.path.join(HERE, 'stubs'))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'www'))
+
+import aiomysql, orm, models
+
+@pytest.fixture
+def run():
+    '''
+    Returns run(coro): runs coro on a new event loop against a fresh stub pool.
+    '''
+    aiomysql.reset()
+    for model in (models.User, models.Blog, models.Comment):
+        if model.__cache__ is not None:
+            model.__cache__.clear()
+
+    def run(coro):
+        async def main():
+            await orm.create_pool(None, user='u', password='p', db='d')
+            try:
+                return await coro
+            finally:
+                await orm.close_pool()
+        return asyncio.run(main())
+    return run
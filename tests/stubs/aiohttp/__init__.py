@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+'''
+A minimal stand-in for aiohttp used by the tests: only aiohttp.web's response classes.
+'''
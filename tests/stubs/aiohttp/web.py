@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+class StreamResponse(object):
+    def __init__(self, status=200, headers=None):
+        self.status = status
+        self.headers = dict(headers or {})
+
+class Response(StreamResponse):
+    def __init__(self, body=None, status=200, text=None, content_type=None, charset=None, headers=None):
+        super(Response, self).__init__(status, headers)
+        self.body = body if text is None else text.encode('utf-8')
+        self.content_type = content_type or 'text/plain'
+        self.charset = charset
+
+class FileResponse(StreamResponse):
+    def __init__(self, path, headers=None):
+        super(FileResponse, self).__init__(200, headers)
+        self.path = path
+
+class HTTPFound(Response):
+    def __init__(self, location):
+        super(HTTPFound, self).__init__(status=302)
+        self.location = location
+
+class HTTPNotModified(Response):
+    def __init__(self, headers=None):
+        super(HTTPNotModified, self).__init__(status=304, headers=headers)
+
+class HTTPBadRequest(Response):
+    def __init__(self, text=''):
+        super(HTTPBadRequest, self).__init__(status=400, text=text)
+
+class HTTPNotFound(Response):
+    def __init__(self):
+        super(HTTPNotFound, self).__init__(status=404)
+
+class HTTPRequestEntityTooLarge(Response):
+    def __init__(self, max_size, actual_size, headers=None):
+        super(HTTPRequestEntityTooLarge, self).__init__(status=413, headers=headers)
+        self.max_size = max_size
+        self.actual_size = actual_size
+
+class HTTPServiceUnavailable(Response):
+    def __init__(self, headers=None):
+        super(HTTPServiceUnavailable, self).__init__(status=503, headers=headers)
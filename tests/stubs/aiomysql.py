@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+'''
+A minimal in-memory stand-in for aiomysql used by the tests.
+Every statement is appended to LOG as (host, sql, args); select results come from ROWS,
+statements containing a substring in FAIL raise an error and those in SLOW take one second.
+'''
+
+import asyncio
+
+LOG = []
+# sql的子串 => 行的list，或由(sql, args)返回行的函数
+ROWS = {}
+# sql中含有这些子串时execute抛出异常
+FAIL = []
+# sql中含有这些子串时execute要执行1秒
+SLOW = []
+
+class DictCursor(object): pass
+class Cursor(object): pass
+class SSDictCursor(object): pass
+class SSCursor(object): pass
+
+class OperationalError(Exception): pass
+
+def reset():
+    del LOG[:]
+    ROWS.clear()
+    del FAIL[:]
+    del SLOW[:]
+
+class _Cursor(object):
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self.rowcount = 0
+        self._rs = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def close(self):
+        pass
+
+    async def execute(self, sql, args=()):
+        await asyncio.sleep(1 if [s for s in SLOW if s in sql] else 0)
+        for s in FAIL:
+            if s in sql:
+                raise OperationalError('failed: %s' % sql)
+        self.conn.log(sql, tuple(args) if args else ())
+        self.rowcount = 1
+        self._rs = []
+        for k, v in ROWS.items():
+            if k in sql:
+                self._rs = list(v(sql, args) if callable(v) else v)
+        if self.kind in (Cursor, SSCursor):
+            self._rs = [tuple(r.values()) for r in self._rs]
+
+    async def executemany(self, sql, seq):
+        seq = list(seq)
+        self.conn.log('MANY ' + sql, len(seq))
+        self.rowcount = len(seq)
+
+    async def fetchall(self):
+        rs, self._rs = self._rs, []
+        return rs
+
+    async def fetchmany(self, n=1):
+        rs, self._rs = self._rs[:n], self._rs[n:]
+        return rs
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+class Connection(object):
+    threads = 0
+
+    def __init__(self, host):
+        Connection.threads += 1
+        self.host = host
+        self.closed = False
+        self._thread_id = Connection.threads
+        # 事务中的语句在commit前只记在这里，rollback时丢弃
+        self._tx = None
+
+    def log(self, sql, args):
+        if self._tx is not None:
+            self._tx.append((self.host, sql, args))
+        else:
+            LOG.append((self.host, sql, args))
+
+    def cursor(self, kind=None):
+        return _Cursor(self, kind)
+
+    async def begin(self):
+        self._tx = []
+
+    async def commit(self):
+        LOG.extend(self._tx or [])
+        self._tx = None
+
+    async def rollback(self):
+        self._tx = None
+
+    def thread_id(self):
+        return self._thread_id
+
+    def close(self):
+        self.closed = True
+
+class Pool(object):
+    def __init__(self, **kw):
+        self.kw = kw
+        self.maxsize = kw.get('maxsize', 10)
+        self.minsize = kw.get('minsize', 1)
+        self._free = []
+        self._used = set()
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def acquire(self):
+        await asyncio.sleep(0)
+        conn = self._free.pop(0) if self._free else Connection(self.kw.get('host', 'localhost'))
+        self._used.add(conn)
+        return conn
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed:
+            self._free.append(conn)
+        fut = asyncio.get_event_loop().create_future()
+        fut.set_result(None)
+        return fut
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+async def create_pool(**kw):
+    return Pool(**kw)
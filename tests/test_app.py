@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import app
+
+def test_serve_does_not_restart_a_worker_after_stop_during_backoff(monkeypatch):
+    handlers, forked, waits = {}, [], [(100, 0)]
+    monkeypatch.setattr(app.signal, 'signal', lambda signum, handler: handlers.__setitem__(signum, handler))
+    monkeypatch.setattr(app.os, 'fork', lambda: forked.append(100 + len(forked)) or forked[-1])
+    monkeypatch.setattr(app.os, 'kill', lambda pid, signum: None)
+
+    def wait():
+        if not waits:
+            raise ChildProcessError()
+        return waits.pop()
+    monkeypatch.setattr(app.os, 'wait', wait)
+    # 退避的一秒中收到SIGTERM
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: handlers[app.signal.SIGTERM](app.signal.SIGTERM, None))
+    app.serve(app.parse_args(['--workers', '1']))
+    assert forked == [100]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import asyncio, os
+
+import coroweb
+
+class Content(object):
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self.data), n):
+            yield self.data[i:i + n]
+
+class Part(object):
+    def __init__(self, name, data, filename=None):
+        self.name = name
+        self.filename = filename
+        self.data = data
+        self.headers = {'Content-Type': 'text/plain'}
+
+    async def read_chunk(self, n):
+        chunk, self.data = self.data[:n], self.data[n:]
+        return chunk
+
+    def get_charset(self, default):
+        return default
+
+class Reader(object):
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    async def next(self):
+        return self.parts.pop(0) if self.parts else None
+
+class Request(object):
+    charset = None
+
+    def __init__(self, method='GET', path='/', query_string='', headers=None, content_type=None, data=b'',
+            content_length=None, parts=(), match_info=None):
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.headers = headers or {}
+        self.content_type = content_type
+        self.content = Content(data)
+        self.content_length = content_length
+        self.match_info = match_info or {}
+        self._parts = parts
+
+    async def multipart(self):
+        return Reader(self._parts)
+
+seen = {}
+
+@coroweb.post('/api/upload', max_body=100)
+async def api_upload(*, title, file=None):
+    seen['file'] = file
+    seen['data'] = file and open(file.path).read()
+    return dict(title=title)
+
+def call(fn, request):
+    return asyncio.run(coroweb.RequestHandler(None, fn)(request))
+
+def test_json_body_is_parsed_and_capped():
+    assert call(api_upload, Request('POST', content_type='application/json', data=b'{"title":"t"}')) == dict(title='t')
+    r = call(api_upload, Request('POST', content_type='application/json', data=b'{"title":"' + b'x' * 200 + b'"}'))
+    assert r.status == 413
+
+def test_content_length_over_limit_is_rejected_before_reading():
+    r = call(api_upload, Request('POST', content_type='application/json', data=b'', content_length=1000))
+    assert r.status == 413 and r.actual_size == 1000
+
+def test_multipart_upload_goes_to_a_temp_file_removed_afterwards():
+    r = call(api_upload, Request('POST', content_type='multipart/form-data',
+        parts=[Part('title', b'hi'), Part('file', b'file data', 'a.txt')]))
+    assert r == dict(title='hi')
+    assert seen['data'] == 'file data' and seen['file'].filename == 'a.txt'
+    assert not os.path.exists(seen['file'].path)
+
+def test_multipart_over_limit_is_rejected_and_cleaned_up():
+    before = set(os.listdir(coroweb.UPLOAD_DIR or __import__('tempfile').gettempdir()))
+    r = call(api_upload, Request('POST', content_type='multipart/form-data',
+        parts=[Part('title', b'hi'), Part('file', b'x' * 200, 'a.txt')]))
+    assert r.status == 413
+    after = set(os.listdir(coroweb.UPLOAD_DIR or __import__('tempfile').gettempdir()))
+    assert not [f for f in after - before if f.startswith('upload-')]
+
+calls = []
+
+@coroweb.get('/api/blogs', cache=60, models=('blogs',))
+async def api_blogs(*, page='1'):
+    calls.append(page)
+    return dict(page=page)
+
+def test_get_cache_answers_304_without_calling_handler():
+    del calls[:]
+    handler = coroweb.RequestHandler(None, api_blogs)
+    r = asyncio.run(handler(Request(path='/api/blogs', query_string='page=2&a=1')))
+    etag = r.headers['ETag']
+    r = asyncio.run(handler(Request(path='/api/blogs', query_string='a=1&page=2', headers={'If-None-Match': etag})))
+    assert r.status == 304 and calls == ['2']
+
+def test_json_output_is_the_same_with_and_without_orjson():
+    import collections, datetime
+    Row = collections.namedtuple('Row', ['id', 'name'])
+    obj = dict(rows=[Row(1, 'a')], counts={1: 2}, at=datetime.datetime(2020, 1, 2, 3, 4, 5), name='中')
+    fast = coroweb.json_dumps(obj)
+    orjson, coroweb.orjson = coroweb.orjson, None
+    try:
+        slow = coroweb.json_dumps(obj)
+    finally:
+        coroweb.orjson = orjson
+    assert slow == b'{"rows":[{"id":1,"name":"a"}],"counts":{"1":2},"at":"2020-01-02T03:04:05","name":"\xe4\xb8\xad"}'
+    if orjson is not None:
+        assert fast == slow
+
+def test_snowflake_ids_are_serialized_as_strings():
+    from orm import Model, IdField, StringField
+
+    class Node(Model):
+        __table__ = 'nodes'
+        id = IdField(primary_key=True)
+        parent_id = IdField()
+        name = StringField()
+
+    obj = [Node(id=2 ** 60 + 1, parent_id=None, name='a')]
+    expected = b'[{"id":"1152921504606846977","parent_id":null,"name":"a"}]'
+    assert coroweb.json_dumps(obj) == expected
+    orjson, coroweb.orjson = coroweb.orjson, None
+    try:
+        assert coroweb.json_dumps(obj) == expected
+    finally:
+        coroweb.orjson = orjson
+
+def test_accept_encoding_respects_q_values():
+    accept = lambda value, codings=('br', 'gzip'): coroweb.accept_encoding(Request(headers={'Accept-Encoding': value}), codings)
+    assert accept('gzip;q=0.0, br;q=0') is None
+    assert accept('br;q=0.5, gzip') == 'gzip'
+    assert accept('gzip, br') == 'br'
+    assert accept('*, br;q=0') == 'gzip'
+    assert coroweb.accept_encoding(Request(headers={'Accept-Encoding': 'deflate, gzip'})) == 'gzip'
+
+def test_static_files_compress_small_files_once(tmp_path, monkeypatch):
+    (tmp_path / 'a.js').write_bytes(b'var a = 1;\n' * 200)
+    (tmp_path / 'b.css').write_bytes(b'p {}\n' * 400)
+    (tmp_path / 'b.css.gz').write_bytes(b'precompressed')
+    static = coroweb.StaticFiles(str(tmp_path))
+    compressed = []
+    compress = coroweb._compress
+    monkeypatch.setattr(coroweb, '_compress', lambda body, coding: compressed.append(coding) or compress(body, coding))
+    get = lambda name, value: asyncio.run(static.handle(Request(headers={'Accept-Encoding': value}, match_info={'filename': name})))
+    r = get('b.css', 'gzip;q=0, br')
+    assert 'Content-Encoding' not in r.headers and r.body == b'p {}\n' * 400
+    for i in range(2):
+        r = get('a.js', 'gzip')
+        assert r.headers['Content-Encoding'] == 'gzip' and r.headers['ETag'].endswith('-gzip"')
+    assert compressed == ['gzip']
+    assert asyncio.run(coroweb.compress_response(Request(headers={'Accept-Encoding': 'gzip'}), r)) is r and compressed == ['gzip']
+
+@coroweb.get('/api/posts', cache=60)
+async def api_posts():
+    return 'x' * 2000
+
+def test_get_cache_compresses_each_coding_once(monkeypatch):
+    compressed = []
+    compress = coroweb._compress
+    monkeypatch.setattr(coroweb, '_compress', lambda body, coding: compressed.append(coding) or compress(body, coding))
+    handler = coroweb.RequestHandler(None, api_posts)
+    for value in ('gzip', 'gzip', 'deflate', 'identity'):
+        r = asyncio.run(handler(Request(path='/api/posts', headers={'Accept-Encoding': value})))
+        assert r.headers.get('Content-Encoding') == (None if value == 'identity' else value)
+    assert compressed == ['gzip', 'deflate']
+
+def test_models_are_not_copied_without_json_str_columns(monkeypatch):
+    from models import User
+    if coroweb.orjson is None:
+        return
+    monkeypatch.setattr(coroweb.ModelMetaclass, 'json_str', False)
+    copied = []
+    default = coroweb.json_default
+    monkeypatch.setattr(coroweb, 'json_default', lambda obj: copied.append(obj) or default(obj))
+    assert coroweb.json_dumps([User(id='a', name='n')]) == b'[{"id":"a","name":"n"}]'
+    assert not copied
+
+def test_json_fallback_copies_only_what_contains_namedtuples():
+    import collections
+    from models import User
+    Row = collections.namedtuple('Row', ['id'])
+    users, counts = [User(id='a')], dict(a=1)
+    obj = dict(users=users, counts=counts, rows=[Row(1)])
+    plain = coroweb._plain(obj)
+    assert plain is not obj and plain['rows'] == [dict(id=1)] and obj['rows'] == [Row(1)]
+    assert plain['users'] is users and plain['counts'] is counts
+    page = dict(users=users, counts=counts)
+    assert coroweb._plain(page) is page
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import aiomysql, models
+from models import Comment
+
+def test_migrate_ids_drops_indexes_on_id_columns_before_dropping_columns(run):
+    aiomysql.ROWS['information_schema.statistics'] = [dict(_name_='idx_comments_blog_id_created_at'), dict(_name_='idx_comments_user_id')]
+    run(models.migrate_ids([Comment]))
+    alters = [l[1] for l in aiomysql.LOG if l[1].startswith(('alter', 'create'))]
+    assert alters[1] == 'alter table `comments` drop index `idx_comments_blog_id_created_at`, drop index `idx_comments_user_id`'
+    assert alters[2].startswith('alter table `comments` drop primary key')
+    assert 'create index `idx_comments_blog_id_created_at` on `comments` (`blog_id`, `created_at`)' in alters
+    assert 'create index `idx_comments_user_id` on `comments` (`user_id`)' in alters
+
+def test_migrate_ids_aborts_on_duplicate_ids_before_dropping_columns(run):
+    aiomysql.ROWS['having count(*)>1'] = [dict(_id_=42)]
+    with pytest.raises(RuntimeError):
+        run(models.migrate_ids([Comment]))
+    alters = [l[1] for l in aiomysql.LOG if l[1].startswith('alter')]
+    assert alters[-1] == 'alter table `comments` drop column `id_new`, drop column `blog_id_new`, drop column `user_id_new`'
+    assert not [a for a in alters if 'drop primary key' in a or 'drop index' in a]
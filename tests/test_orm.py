@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import aiomysql, orm
+from orm import Model, StringField, IntegerField, IdField, Snowflake
+from models import User, Blog
+
+class Post(Model):
+    __table__ = 'posts'
+    __query_cache_rows__ = 100
+    __query_cache_ttl__ = 60
+
+    id = StringField(primary_key=True)
+    n = IntegerField()
+
+def sqls(prefix=''):
+    return [l[1] for l in aiomysql.LOG if l[1].lower().startswith(prefix)]
+
+def test_save_many_uses_one_executemany(run):
+    counts = run(User.saveMany([dict(name='a'), dict(name='b'), dict(name='c')], batch_size=2))
+    assert counts == [2, 1]
+    assert len(sqls('many insert')) == 2
+
+def test_batch_loader_merges_concurrent_finds(run):
+    aiomysql.ROWS['from `users` where `id` in'] = lambda sql, args: [dict(id=a, name='n' + a) for a in args if a != 'x']
+
+    async def main():
+        return await asyncio.gather(*[User.find(k) for k in ['a', 'b', 'a', 'x']])
+    users = run(main())
+    assert [u and u.name for u in users] == ['na', 'nb', 'na', None]
+    assert len(sqls('select')) == 1
+
+def test_transaction_shares_connection_and_rolls_back(run):
+    async def main():
+        with pytest.raises(KeyError):
+            async with orm.transaction():
+                await orm.execute('update `posts` set `n`=?', [1])
+                assert orm.in_transaction()
+                raise KeyError()
+        assert not orm.in_transaction()
+        async with orm.transaction():
+            await orm.execute('update `posts` set `n`=?', [2])
+            async with orm.transaction():
+                await orm.execute('update `posts` set `n`=?', [3])
+    run(main())
+    assert [l[2] for l in aiomysql.LOG] == [(2,), (3,)]
+
+def test_transaction_does_not_leak_into_other_tasks(run):
+    async def other():
+        return orm.in_transaction()
+
+    async def main():
+        async with orm.transaction():
+            # 新建的task复制当前上下文；而在事务外启动的task看不到这个事务
+            inner = await asyncio.ensure_future(other())
+        return inner, await asyncio.ensure_future(other())
+    assert run(main()) == (True, False)
+
+def test_snowflake_ids_increase_and_carry_worker_id():
+    sf = Snowflake(5)
+    ids = [sf.next_id() for i in range(10000)]
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    assert all((i >> 12) & 0x3ff == 5 for i in ids)
+    with pytest.raises(ValueError):
+        sf.worker_id = 1024
+
+def test_query_cache_runs_one_query_for_concurrent_misses(run):
+    aiomysql.ROWS['from `posts`'] = [dict(id='a', n=1)]
+
+    async def main():
+        rs = await asyncio.gather(*[Post.findAll(orderBy='n') for i in range(5)])
+        await orm.execute('update `posts` set `n`=?', [2])
+        await Post.findAll(orderBy='n')
+        return rs
+    rs = run(main())
+    assert all(r == [dict(id='a', n=1)] for r in rs)
+    # 并发的5次只查询一次，写入后重新查询
+    assert len(sqls('select')) == 2
+
+def test_write_behind_merges_updates(run):
+    async def main():
+        wb = orm.WriteBehind(max_pending=100)
+        for i in range(5):
+            wb.incr(Post, 'n', 'a')
+        wb.incr(Post, 'n', 'b', 2)
+        await wb.flush()
+        return wb.stats()
+    stats = run(main())
+    assert sqls('update') == ['update `posts` set `n` = `n` + case `id` when %s then %s when %s then %s end where `id` in (%s, %s)']
+    assert aiomysql.LOG[0][2] == ('a', 5, 'b', 2, 'a', 'b')
+    assert stats['pending'] == 0 and stats['rows'] == 2
+
+def test_write_behind_flush_does_not_join_callers_transaction(run):
+    async def main():
+        wb = orm.WriteBehind(max_pending=2)
+        with pytest.raises(KeyError):
+            async with orm.transaction():
+                wb.incr(Post, 'n', 'a')
+                wb.incr(Post, 'n', 'b')
+                # 积累到max_pending后安排的写入在事务之外执行
+                await asyncio.sleep(0.01)
+                raise KeyError()
+        await wb.flush()
+        return wb.stats()
+    stats = run(main())
+    assert len(sqls('update')) == 1
+    assert stats['rows'] == 2 and stats['pending'] == 0
+
+def test_write_behind_sets_aside_a_batch_that_keeps_failing(run):
+    async def main():
+        wb = orm.WriteBehind(max_retries=2)
+        wb.incr(Post, 'n', 'a')
+        wb.set(Blog, 'name', 'b', 'x')
+        aiomysql.FAIL.append('`posts`')
+        with pytest.raises(aiomysql.OperationalError):
+            await wb.flush()
+        # 失败的一批放回队列，第二次失败后放弃，不再阻塞后面的更新
+        await wb.flush()
+        return wb
+    wb = run(main())
+    assert wb.stats()['pending'] == 0 and wb.stats()['failed'] == 1
+    assert wb.failed[0][:3] == (Post, 'n', True)
+    assert sqls('update') == ['update `blogs` set `name` = case `id` when %s then %s end where `id` in (%s)']
+
+def test_rows_read_in_a_rolled_back_transaction_are_not_cached(run):
+    aiomysql.ROWS['from `users` where `id`'] = [dict(id='a', name='uncommitted')]
+
+    async def main():
+        with pytest.raises(KeyError):
+            async with orm.transaction():
+                assert (await User.find('a')).name == 'uncommitted'
+                assert (await User.findMany(['a']))[0].name == 'uncommitted'
+                raise KeyError()
+    run(main())
+    assert User.__cache__.get('a') is None
+
+def test_query_cache_charges_empty_results():
+    cache = orm.QueryCache(max_rows=10, ttl=60)
+    for i in range(5000):
+        cache.set(('sql', (i,)), [])
+    assert len(cache._data) == 10 and cache.rows == 10
+
+def test_query_cache_followers_retry_when_the_leader_is_cancelled():
+    cache = orm.QueryCache(max_rows=10, ttl=60)
+    calls = []
+
+    async def query():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return [len(calls)]
+
+    async def main():
+        leader = asyncio.ensure_future(cache.fetch('k', query))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.fetch('k', query))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+    assert asyncio.run(main()) == [2]
+
+def test_query_cache_requires_a_ttl():
+    with pytest.raises(RuntimeError):
+        class NoTtl(Model):
+            __table__ = 'no_ttl'
+            __query_cache_rows__ = 100
+            id = StringField(primary_key=True)
+
+def test_find_after_with_compact_rows(run):
+    aiomysql.ROWS['from `blogs`'] = [dict(id='b%s' % i, created_at=100.0 - i) for i in range(3)]
+
+    async def main():
+        return await Blog.findAfter(limit=2, only=['created_at'], compact=True)
+    rs, cursor = run(main())
+    assert [r.id for r in rs] == ['b0', 'b1']
+    assert orm.decode_cursor(cursor) == (99.0, 'b1')
+
+def test_find_many_pads_in_lists_to_powers_of_two(run):
+    aiomysql.ROWS['from `users` where `id` in'] = lambda sql, args: [dict(id=a, name=a) for a in dict.fromkeys(args)]
+
+    async def main():
+        found = []
+        for n in range(1, 40):
+            found.append(await User.findMany(['u%s-%s' % (n, i) for i in range(n)]))
+        return found
+    found = run(main())
+    assert all([u.id for u in users] == ['u%s-%s' % (n, i) for i in range(n)] for n, users in enumerate(found, 1))
+    assert set(len(l[2]) for l in aiomysql.LOG) == {1, 2, 4, 8, 16, 32, 64}
+    assert len(set(l[1] for l in aiomysql.LOG)) == 7
+
+def test_read_your_writes_only_affects_the_writing_context():
+    async def read():
+        await orm.select('select 1', [])
+        return aiomysql.LOG[-1][0]
+
+    async def write_then_read():
+        await orm.execute('update `posts` set `n`=?', [1])
+        return await read()
+
+    async def main():
+        await orm.create_pool(None, host='primary', user='u', password='p', db='d', replicas=[dict(host='replica')])
+        try:
+            # 每个task相当于一个请求
+            wrote = await asyncio.ensure_future(write_then_read())
+            other = await asyncio.ensure_future(read())
+            return wrote, other
+        finally:
+            await orm.close_pool()
+    aiomysql.reset()
+    assert asyncio.run(main()) == ('primary', 'replica')
+
+def test_adaptive_pool_trims_idle_connections_to_the_recent_peak():
+    async def hold():
+        async with orm.connection():
+            await asyncio.sleep(0.03)
+
+    async def main():
+        await orm.create_pool(None, user='u', password='p', db='d', maxsize=20, warm=8, adaptive=True, adapt_interval=0.02)
+        try:
+            pool = orm.pool_stats()[0]
+            sizes = [pool['size']]
+            await asyncio.gather(hold(), hold(), hold())
+            await asyncio.sleep(0.01)
+            sizes.append(orm.pool_stats()[0]['size'])
+            await asyncio.sleep(0.1)
+            sizes.append(orm.pool_stats()[0]['size'])
+            return sizes
+        finally:
+            await orm.close_pool()
+    aiomysql.reset()
+    first, busy, idle = asyncio.run(main())
+    # 从不超过预先建立的8个，空闲后只保留headroom个
+    assert first == 8 and busy <= 8 and idle == 2
+
+def test_find_page_rejects_invalid_page_and_size(run):
+    for page, size in ((0, 10), (-1, 10), (1, 0)):
+        with pytest.raises(ValueError):
+            run(Post.findPage(page=page, size=size))
+    assert not aiomysql.LOG
+
+class Node(Model):
+    __table__ = 'nodes'
+    __cache_size__ = 10
+    __cache_ttl__ = 60
+    __batch_find__ = True
+
+    id = IdField(primary_key=True)
+    name = StringField()
+
+def test_find_accepts_string_snowflake_ids(run):
+    aiomysql.ROWS['from `nodes`'] = lambda sql, args: [dict(id=a, name='n') for a in args]
+
+    async def main():
+        # 第一次经BatchLoader合并查询，第二次由缓存返回
+        found = [await Node.find(str(2 ** 60 + 1)) for i in range(2)]
+        return found + await Node.findMany([str(2 ** 60 + 1), 2 ** 60 + 1])
+    found = run(main())
+    assert all(n is not None and n.id == 2 ** 60 + 1 for n in found)
+    assert len(sqls('select')) == 1
+
+def test_query_timeout_kills_the_query_on_the_server(run):
+    aiomysql.SLOW.append('sleep')
+    first = aiomysql.Connection.threads + 1
+
+    async def main():
+        with pytest.raises(orm.QueryTimeoutError):
+            await orm.select('select sleep(10)', [], timeout=0.05)
+        # KILL QUERY在另一个连接上执行
+        await asyncio.sleep(0.05)
+    run(main())
+    assert sqls('kill') == ['KILL QUERY %d' % first]
+
+def test_slow_query_log_and_stats_leave_out_args(run, caplog):
+    async def main():
+        orm.set_slow_query(0)
+        await orm.execute('update `users` set `passwd`=? where `id`=?', ['secret', 'a'])
+        await orm.select('select * from `users` where `email`=?', ['a@b.c'])
+        return await orm.explain_queries()
+    assert run(main()) == []
+    assert 'slow query' in caplog.text and 'secret' not in caplog.text and 'a@b.c' not in caplog.text
+    assert all(stat[3] is None for stat in getattr(orm, '__query_stats').values())
+    assert not [s for s in sqls('explain') if '?' in s]
@@ -6,27 +6,144 @@ __author__ = 'lzh'
 import logging; logging.basicConfig(level=logging.INFO)
 #分号为断开两句话，第二句指定记录信息的级别
 
-import asyncio, os, json, time
+import asyncio, os, json, time, argparse, signal
 from datetime import datetime
 
 from aiohttp import web
 
+import orm, models
+from coroweb import make_response, compress_response
+
 def index(request): #负责响应http请求并返回一个HTML，后面将与具体的url绑定
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')
 
-@asyncio.coroutine #把一个generator标记为coroutine类型即srv
-def init(loop):
-    app = web.Application(loop=loop) #创建web服务器实例app
-    app.router.add_route('GET', '/', index) #将处理函数index（）注册
+# 响应中间件：把视图函数返回的dict，list，str等转换为web.Response，再按Accept-Encoding压缩
+async def response_factory(app, handler):
+    async def response(request):
+        r = await handler(request)
+        resp = make_response(r)
+        return await compress_response(request, resp)
+    return response
+
+# 关闭服务时写入WriteBehind中积累的更新并关闭连接池
+async def on_cleanup(app):
+    await orm.close_pool()
 
+# 每个进程有自己的事件循环和连接池，reuse_port=True时多个进程监听同一个端口，由内核把新连接分配给各个进程
+async def init(loop, host='127.0.0.1', port=9000, reuse_port=False, **db):
+    await orm.create_pool(loop, **db)
+    app = web.Application(loop=loop, middlewares=[response_factory]) #创建web服务器实例app
+    app.router.add_route('GET', '/', index) #将处理函数index（）注册
+    app.on_cleanup.append(on_cleanup)
+    handler = app.make_handler()
     #利用协程创建TCP监听服务,loop为传入函数的协程，app.make_handler()得到IP包的编号吧
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...') #输入一段文本
-    return srv
+    srv = await loop.create_server(handler, host, port, reuse_port=reuse_port)
+    logging.info('server started at http://%s:%s (pid %s)...' % (host, port, os.getpid())) #输入一段文本
+    return app, srv, handler
+
+# 运行一个进程：收到SIGTERM或SIGINT后不再接受新连接，等正在处理的请求完成(最多drain_timeout秒)后退出
+def run_worker(args, index=0):
+    loop = asyncio.new_event_loop() #每个进程创建自己的EventLoop
+    asyncio.set_event_loop(loop)
+    # 每个进程的snowflake主键使用不同的worker id
+    models.snowflake.worker_id = args.worker_id_base + index
+    app, srv, handler = loop.run_until_complete(init(loop, args.host, args.port, args.workers > 1, **db_config(args)))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    loop.run_forever() #不断运行协程，直到调用stop()
+    logging.info('worker %s (pid %s) draining...' % (index, os.getpid()))
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(handler.shutdown(args.drain_timeout))
+    loop.run_until_complete(app.cleanup())
+    loop.close()
+
+# 主进程：fork出workers个进程并监视，进程意外退出时重新启动；收到SIGTERM或SIGINT时通知所有进程退出并等待它们结束
+def serve(args):
+    # pid => (进程序号, 启动时间)
+    workers = dict()
+    stopping = []
 
-loop = asyncio.get_event_loop() #获取EventLoop,一种机制？创建协程
-loop.run_until_complete(init(loop)) #运行协程
-loop.run_forever() #不断运行协程，直到调用stop()
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                run_worker(args, index)
+            except BaseException as e:
+                logging.exception('worker %s failed: %s' % (index, e))
+                code = 1
+            finally:
+                # 子进程不能返回到主进程的代码中
+                os._exit(code)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(workers):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        spawn(index)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in workers:
+            continue
+        index, started = workers.pop(pid)
+        if stopping:
+            continue
+        logging.warning('worker %s (pid %s) exited with status %s, restarting...' % (index, pid, status))
+        # 启动后马上又退出的(如连不上数据库)，等一秒再重启，避免不停地fork
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+            # 等待期间收到了SIGTERM或SIGINT，stop()通知不到新进程，不再重启
+            if stopping:
+                continue
+        spawn(index)
+    logging.info('server stopped.')
+
+# 数据库配置：命令行参数，默认值来自环境变量
+def db_config(args):
+    return dict(host=args.db_host, port=args.db_port, user=args.db_user, password=args.db_password, db=args.db_name,
+        maxsize=args.db_maxsize)
+
+def parse_args(argv=None):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='awesome-python3-webapp server')
+    parser.add_argument('--host', default=env('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(env('PORT', 9000)))
+    parser.add_argument('--workers', type=int, default=int(env('WORKERS', 1)),
+        help='number of worker processes, usually the number of cores')
+    parser.add_argument('--worker-id-base', type=int, default=int(env('WORKER_ID_BASE', 0)),
+        help='snowflake worker id of the first process, must not overlap between hosts')
+    parser.add_argument('--drain-timeout', type=float, default=float(env('DRAIN_TIMEOUT', 10)),
+        help='seconds to wait for in-flight requests on shutdown')
+    parser.add_argument('--db-host', default=env('DB_HOST', '127.0.0.1'))
+    parser.add_argument('--db-port', type=int, default=int(env('DB_PORT', 3306)))
+    parser.add_argument('--db-user', default=env('DB_USER', 'www-data'))
+    parser.add_argument('--db-password', default=env('DB_PASSWORD', 'www-data'))
+    parser.add_argument('--db-name', default=env('DB_NAME', 'awesome'))
+    # 多进程时每个进程各自持有db-maxsize个连接，总数不能超过MySQL的max_connections
+    parser.add_argument('--db-maxsize', type=int, default=int(env('DB_MAXSIZE', 10)),
+        help='database connections per process')
+    return parser.parse_args(argv)
+
+# python3 app.py --host 0.0.0.0 --workers 32
+# 只有一个进程时不fork，直接在当前进程中运行
+if __name__ == '__main__':
+    args = parse_args()
+    if args.workers > 1:
+        serve(args)
+    else:
+        run_worker(args)
 
 '''
 一、
@@ -37,4 +154,4 @@ yield from的作用是使srv的行为模式和 loop.create_server()一致
 总结：
 不断利用一个协程来处理一个能监听服务，若监听成功则调用index（）将一个HTML返回给浏览器的协程
 监听条件，需注册web服务器和将处理函数index（）注册到路由中
-'''
\ No newline at end of file
+'''
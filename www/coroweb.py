@@ -4,15 +4,25 @@
 __author__ = 'lzh'
 
 # inspect模块，检查视图函数的参数
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, json, zlib, datetime, decimal, hashlib, time, re, collections, mimetypes, tempfile
+from email.utils import formatdate, parsedate_to_datetime
 
 from urllib import parse
 from aiohttp import web
 from apis import APIError
+from orm import DatabaseBusyError, LRUCache, ModelMetaclass, on_table_write
 
-def get(path):
+# 装了orjson就用它序列化JSON，比标准库快数倍，直接输出utf-8的bytes
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def get(path, cache=None, models=()):
     '''
     Define decorator @get('/path')
+    @get('/api/blogs', cache=60, models=(Blog,)) caches the rendered response for 60 seconds,
+    or until a table of the given models is written.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -21,12 +31,16 @@ def get(path):
         # 装饰后添加两个属性
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__cache_ttl__ = cache
+        wrapper.__cache_models__ = tuple(models)
         return wrapper
     return decorator
     
-def post(path):
+def post(path, max_body=None, stream=False):
     '''
     Define decorator @post('/path')
+    max_body limits the request body in bytes (default MAX_BODY).
+    stream=True passes the body to the handler as the async iterator argument `chunks` instead of parsing it.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -34,9 +48,273 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__max_body__ = max_body
+        wrapper.__stream__ = stream
         return wrapper
     return decorator
 
+# 请求体默认的大小上限，上传文件等需要更大请求体的路由用@post(path, max_body=...)单独设置
+MAX_BODY = 1024 * 1024
+# 读取请求体时每次读取的字节数
+CHUNK_SIZE = 64 * 1024
+# multipart上传的文件保存的目录，None为系统的临时目录
+UPLOAD_DIR = None
+
+class BodyTooLarge(Exception):
+    def __init__(self, limit, size=None):
+        super(BodyTooLarge, self).__init__('request body exceeds %s bytes' % limit)
+        self.limit = limit
+        self.size = size
+
+# 逐块读取请求体，超过limit字节时抛出BodyTooLarge，没有Content-Length(chunked)的请求也能限制
+async def iter_body(request, limit):
+    size = 0
+    async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(limit, size)
+        yield chunk
+
+async def read_body(request, limit):
+    body = bytearray()
+    async for chunk in iter_body(request, limit):
+        body.extend(chunk)
+    return bytes(body)
+
+# multipart上传的文件：已经写入path处的临时文件，视图函数返回后临时文件被删除，需要保留的用os.replace()移走
+class UploadedFile(object):
+    def __init__(self, name, filename, content_type, path, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size = size
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __repr__(self):
+        return '<UploadedFile %s %s (%s bytes)>' % (self.name, self.filename, self.size)
+
+# 逐个读取multipart的部分：普通字段读为str，文件逐块写入临时文件(在线程池中写，不阻塞事件循环)得到UploadedFile
+# 所有部分合计超过limit字节时抛出BodyTooLarge；files收集已写入的文件，出错时由调用者删除
+async def read_multipart(request, limit, files):
+    params = dict()
+    loop = asyncio.get_event_loop()
+    size = 0
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            return params
+        if part.filename:
+            fd, path = tempfile.mkstemp(prefix='upload-', dir=UPLOAD_DIR)
+            upload = UploadedFile(part.name, part.filename, part.headers.get('Content-Type', 'application/octet-stream'), path, 0)
+            files.append(upload)
+            with os.fdopen(fd, 'wb') as fp:
+                while True:
+                    chunk = await part.read_chunk(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise BodyTooLarge(limit, size)
+                    upload.size += len(chunk)
+                    await loop.run_in_executor(None, fp.write, chunk)
+            params[part.name] = upload
+        else:
+            value = bytearray()
+            while True:
+                chunk = await part.read_chunk(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise BodyTooLarge(limit, size)
+                value.extend(chunk)
+            params[part.name] = value.decode(part.get_charset('utf-8'))
+
+# JSON不能直接表示的类型：compact=True查询得到的namedtuple行，datetime，Decimal(如sum()的结果)
+# Model的snowflake id列(__json_str__)超过JavaScript能精确表示的2^53，输出为字符串
+def json_default(obj):
+    if isinstance(obj, dict):
+        return _json_str(obj)
+    # OPT_PASSTHROUGH_SUBCLASS时orjson把str，int，list的子类也交给这里
+    for t in (str, int, list):
+        if isinstance(obj, t):
+            return t(obj)
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+def _json_str(obj):
+    d = dict(obj)
+    for k in getattr(obj, '__json_str__', ()):
+        if d.get(k) is not None:
+            d[k] = str(d[k])
+    return d
+
+# 标准库json把namedtuple当作tuple输出为数组，不会调用json_default，先转换为dict，与orjson的输出一致
+# 只复制含有namedtuple或需要转换id列的Model的dict和list，其余原样返回，Model的值都是普通的列值，不必深入
+def _plain(obj):
+    if hasattr(obj, '_asdict'):
+        return _plain(obj._asdict())
+    if hasattr(obj, '__json_str__'):
+        return _json_str(obj) if obj.__json_str__ else obj
+    if not isinstance(obj, (dict, list, tuple)):
+        return obj
+    copy = None
+    for k, v in (obj.items() if isinstance(obj, dict) else enumerate(obj)):
+        p = _plain(v)
+        if p is not v:
+            if copy is None:
+                copy = dict(obj) if isinstance(obj, dict) else list(obj)
+            copy[k] = p
+    return obj if copy is None else copy
+
+# 序列化为utf-8编码的JSON，两种序列化的输出相同：namedtuple输出为对象，非字符串的key转换为字符串
+# 只有Model声明了__json_str__(snowflake模式)时，orjson才把Model等dict的子类交给json_default复制并转换id列，否则直接序列化
+def json_dumps(obj):
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_PASSTHROUGH_SUBCLASS if ModelMetaclass.json_str else 0)
+        return orjson.dumps(obj, default=json_default, option=option)
+    return json.dumps(_plain(obj), ensure_ascii=False, separators=(',', ':'), default=json_default).encode('utf-8')
+
+# 把视图函数的返回值转换为web.Response：
+# web.StreamResponse原样返回；bytes；str(以redirect:开头的为重定向)；dict，list返回JSON；int为状态码；(状态码, 消息)
+def make_response(r):
+    if isinstance(r, web.StreamResponse):
+        return r
+    if isinstance(r, bytes):
+        return web.Response(body=r, content_type='application/octet-stream')
+    if isinstance(r, str):
+        if r.startswith('redirect:'):
+            return web.HTTPFound(r[9:])
+        return web.Response(body=r.encode('utf-8'), content_type='text/html', charset='utf-8')
+    if isinstance(r, (dict, list)):
+        return web.Response(body=json_dumps(r), content_type='application/json', charset='utf-8')
+    if isinstance(r, int) and 100 <= r < 600:
+        return web.Response(status=r)
+    if isinstance(r, tuple) and len(r) == 2 and isinstance(r[0], int) and 100 <= r[0] < 600:
+        return web.Response(status=r[0], text=str(r[1]))
+    return web.Response(body=str(r).encode('utf-8'), content_type='text/plain', charset='utf-8')
+
+# 小于COMPRESS_MIN_SIZE字节的响应压缩后省不了多少，不压缩；大于COMPRESS_EXECUTOR_SIZE的在线程池中压缩，不阻塞事件循环
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_EXECUTOR_SIZE = 256 * 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+# 按Accept-Encoding从codings中选择编码：q=0的不接受，没有列出的取*的q值，q值相同时优先codings中靠前的，都不接受时返回None
+def accept_encoding(request, codings=('gzip', 'deflate')):
+    qs = dict()
+    for item in request.headers.get('Accept-Encoding', '').lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                continue
+        qs[coding.strip()] = q
+    best, best_q = None, 0
+    for name in codings:
+        q = qs.get(name, qs.get('*', 0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def _compress(body, coding):
+    # wbits为16+MAX_WBITS时输出gzip格式，MAX_WBITS时输出HTTP的deflate(即zlib)格式
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS if coding == 'gzip' else zlib.MAX_WBITS)
+    return c.compress(body) + c.flush()
+
+# 按客户端支持的编码压缩响应体，只处理body为bytes的文本类响应
+# cache为dict时按编码保存压缩后的body，同样的内容只压缩一次
+async def compress_response(request, resp, cache=None):
+    body = getattr(resp, 'body', None)
+    if not isinstance(body, bytes) or len(body) < COMPRESS_MIN_SIZE or resp.status in (204, 304) \
+            or 'Content-Encoding' in resp.headers or not resp.content_type.startswith(COMPRESSIBLE_TYPES):
+        return resp
+    vary = resp.headers.get('Vary', '')
+    if 'accept-encoding' not in vary.lower():
+        resp.headers['Vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+    coding = accept_encoding(request)
+    if coding is None:
+        return resp
+    if cache is not None and coding in cache:
+        body = cache[coding]
+    elif len(body) >= COMPRESS_EXECUTOR_SIZE:
+        body = await asyncio.get_event_loop().run_in_executor(None, _compress, body, coding)
+    else:
+        body = _compress(body, coding)
+    if cache is not None:
+        cache[coding] = body
+    resp.body = body
+    resp.headers['Content-Encoding'] = coding
+    # 强ETag对应字节完全相同的内容，压缩后的内容用不同的ETag
+    etag = resp.headers.get('ETag')
+    if etag and etag.startswith('"'):
+        resp.headers['ETag'] = '%s-%s"' % (etag[:-1], coding)
+    return resp
+
+# 缓存的响应：响应体，Content-Type，charset，ETag，生成的时间，编码 => 压缩后的响应体
+CachedResponse = collections.namedtuple('CachedResponse', ['body', 'content_type', 'charset', 'etag', 'last_modified', 'compressed'])
+
+# @get(path, cache=ttl)的响应缓存，按路径和排序后的查询字符串缓存生成好的响应
+# models的表被写入时(由orm的on_table_write通知)全部失效
+class ResponseCache(object):
+    def __init__(self, ttl, models=(), maxsize=1000):
+        self._cache = LRUCache(maxsize, ttl)
+        # 每次失效加一，生成响应的过程中失效过的，生成的响应不放入缓存
+        self.generation = 0
+        for model in models:
+            on_table_write(getattr(model, '__table__', model), self.clear)
+
+    @staticmethod
+    def key(request):
+        return request.path + '?' + parse.urlencode(sorted(parse.parse_qsl(request.query_string, True)))
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, resp, generation):
+        entry = CachedResponse(resp.body, resp.content_type, resp.charset,
+            '"%s"' % hashlib.blake2b(resp.body, digest_size=16).hexdigest(), time.time(), dict())
+        if generation == self.generation:
+            self._cache.set(key, entry)
+        return entry
+
+    def clear(self, table=None):
+        self._cache.clear()
+        self.generation += 1
+
+    def stats(self):
+        return self._cache.stats()
+
+# 客户端缓存的版本是否还是最新的：有If-None-Match时比较ETag(忽略W/和压缩编码的后缀)，否则比较If-Modified-Since
+def not_modified(request, entry):
+    inm = request.headers.get('If-None-Match')
+    if inm is not None:
+        tags = [re.sub(r'-(gzip|deflate|br)"$', '"', t.strip()[2:] if t.strip().startswith('W/') else t.strip()) for t in inm.split(',')]
+        return '*' in tags or entry.etag in tags
+    ims = request.headers.get('If-Modified-Since')
+    if ims is not None:
+        try:
+            return int(entry.last_modified) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 # inspect.Parameter.kind 类型：  
 # POSITIONAL_ONLY          位置参数  
 # VAR_POSITIONAL           可选参数 *args  
@@ -89,7 +367,7 @@ request参数位置在最后因为参数获取顺序不能轻易改变，否则
 # 判断是否含有名为'request'的参数，且其参数位置在最后
 def has_request_arg(fn):
     sig = inspect.signature(fn)
-    params = sig.paramters
+    params = sig.parameters
     found = False
     for name, param in params.items():
         if name == 'request':
@@ -115,16 +393,70 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._max_body = getattr(fn, '__max_body__', None) or MAX_BODY
+        self._stream = getattr(fn, '__stream__', False)
+        ttl = getattr(fn, '__cache_ttl__', None)
+        self._cache = ResponseCache(ttl, getattr(fn, '__cache_models__', ())) if ttl else None
     
     # __call__可以使对象看作为函数，如p对象，若调用__call__方法则直接执行p(request)    
-    # 将获取的参数经处理，使其完全符合视图函数接收的参数形式
     async def __call__(self, request):
+        try:
+            if self._cache is not None and request.method == 'GET':
+                return await self._cached(request)
+            return await self._call(request)
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+        except BodyTooLarge as e:
+            # 已经开始读取的请求体不再读完，关闭连接
+            return web.HTTPRequestEntityTooLarge(max_size=e.limit, actual_size=e.size or e.limit + 1, headers={'Connection': 'close'})
+        except DatabaseBusyError as e:
+            # 数据库过载时立即返回503，告诉客户端多久后重试，而不是让请求在事件循环中越积越多
+            logging.warning('database busy: %s' % e)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': str(e.retry_after)})
+
+    # 先查响应缓存，客户端的版本仍是最新的时直接返回304，都不需要调用视图函数
+    # 带Cookie或Authorization的请求的响应可能因用户而异，不使用缓存
+    async def _cached(self, request):
+        if 'Cookie' in request.headers or 'Authorization' in request.headers:
+            return await self._call(request)
+        key = self._cache.key(request)
+        entry = self._cache.get(key)
+        if entry is None:
+            generation = self._cache.generation
+            resp = make_response(await self._call(request))
+            # 只缓存正常的完整响应
+            if resp.status != 200 or not isinstance(getattr(resp, 'body', None), bytes) or 'Set-Cookie' in resp.headers:
+                return resp
+            entry = self._cache.set(key, resp, generation)
+        headers = {'ETag': entry.etag, 'Last-Modified': formatdate(entry.last_modified, usegmt=True), 'Cache-Control': 'no-cache'}
+        if not_modified(request, entry):
+            return web.HTTPNotModified(headers=headers)
+        resp = web.Response(body=entry.body, content_type=entry.content_type, charset=entry.charset, headers=headers)
+        return await compress_response(request, resp, entry.compressed)
+
+    # 将获取的参数经处理，使其完全符合视图函数接收的参数形式
+    async def _call(self, request):
+        # Content-Length已经超过上限的请求不读取请求体，直接返回413
+        if request.method == 'POST' and request.content_length is not None and request.content_length > self._max_body:
+            raise BodyTooLarge(self._max_body, request.content_length)
+        # multipart上传的文件，视图函数返回后删除
+        files = []
+        try:
+            return await self._parse_and_call(request, files)
+        finally:
+            for f in files:
+                f.remove()
+
+    async def _parse_and_call(self, request, files):
         # kw保存参数视图函数（url处理函数或路由函数）中所需参数
         kw = None
         # 若视图函数需要关键字参数，命名关键字参数，或者无默认值的命名关键字参数
         if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+            # stream=True时不解析请求体，交给视图函数逐块读取：async for chunk in chunks
+            if request.method == 'POST' and self._stream:
+                kw = dict(chunks=iter_body(request, self._max_body))
             # 若客户端传来的方法为'POST'
-            if request.method == 'POST':
+            elif request.method == 'POST':
                 # 若没有提交数据的格式(text/html,application/json)
                 if not request.content_type:
                     return web.HTTPBadRequest(text='Missing Content-Type.')
@@ -133,15 +465,22 @@ class RequestHandler(object):
                 # startswith检查是否以'application/json'开头
                 if ct.startswith('application/json'):
                     # 仅解析body字段的json数据，返回dict
-                    params = await request.json()
+                    try:
+                        params = json.loads(await read_body(request, self._max_body))
+                    except ValueError:
+                        return web.HTTPBadRequest(text='Invalid JSON body.')
                     if not isinstance(params, dict):
                         return web.HTTPBadRequest(text='JSON body must be object.')
                     kw = params
                 # 若是form表单请求的编码形式
-                elif ct.startswith('application/x-www-form-rulencoded') or ct.startswith('multipart/form-data'):
-                    # 返回post的内容中解析后的数据
-                    params = await request.post()
-                    kw = dict(**params)
+                elif ct.startswith('application/x-www-form-urlencoded'):
+                    body = await read_body(request, self._max_body)
+                    kw = dict()
+                    for k, v in parse.parse_qs(body.decode(request.charset or 'utf-8'), True).items():
+                        kw[k] = v[0]
+                # 上传文件的表单逐块读取，文件写入临时文件而不是全部放在内存中
+                elif ct.startswith('multipart/form-data'):
+                    kw = await read_multipart(request, self._max_body, files)
                 else:
                     return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)                
             if request.method == 'GET':
@@ -178,7 +517,7 @@ class RequestHandler(object):
                 kw[k] = v
         # 若视图函数需要request参数，将request对象保存
         if self._has_request_arg:
-            kw['requset'] = request
+            kw['request'] = request
         # 若需要默认值为空的命名关键字参数，这个参数必须有值否则报错
         if self._required_kw_args:
             for name in self._required_kw_args:
@@ -186,70 +525,156 @@ class RequestHandler(object):
                 if not name in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
         logging.info('call with args: %s' % str(kw))
-        try:
-            # 将把Request对象经过筛选的参数，传递给了视图函数
-            r = await self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+        # 将把Request对象经过筛选的参数，传递给了视图函数
+        r = await self._func(**kw)
+        return r
     
-    '''
-    在app中注册视图函数（添加路由）。
-    add_route函数功能：
-    1、验证视图函数是否拥有method和path参数
-    2、将视图函数转变为协程
-    '''
-    # 用于注册静态文件（如image，css，javascript等），只提供文件路径即可进行注册
-    def add_static(app):
-        # 当前文件夹的绝对路径与'static'拼接合成路径
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-        app.router.add_static('/static/', path)
-        logging.info('add static %s => %s' % ('/static/', path))
-        
-    # 注册视图函数(添加路由)    
-    def add_route(app, fn):
-        # 从fn中得到'__method__'属性值，若无则默认为空
-        method = getattr(fn, '__method__', None)
-        path = getattr(fn, '__route__', None)
-        if path is None or method is None:
-            raise ValueError('@get or @post not defined in %s.' % str(fn))
-        # 判断URL处理函数(视图函数)是否协程并且是生成器 
-        if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-            # 变为协程因为需要执行异步IO
-            fn = asyncio.coroutine(fn)
-        logging.info('add route %s %s =? %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-        # 在app中注册经RequestHandler类封装(调用了__call__方法)的视图函数，
-        app.router.add_route(method, path, RequestHandler(app, fn))
+'''
+在app中注册视图函数（添加路由）。
+add_route函数功能：
+1、验证视图函数是否拥有method和path参数
+2、将视图函数转变为协程
+'''
+# 一个静态文件：路径，Content-Type，内容的hash，大小，修改时间，预压缩的文件{'br': 路径, 'gzip': 路径}
+StaticFile = collections.namedtuple('StaticFile', ['path', 'content_type', 'digest', 'size', 'mtime', 'encodings'])
+
+# 静态文件：启动时计算每个文件内容的hash，url('css/a.css')得到/static/css/a.<hash>.css，
+# 带hash的url内容永远不变，客户端可以一直缓存；原来的url仍然可用，但每次都要用ETag验证
+# 有a.css.br或a.css.gz时按Accept-Encoding直接发送预压缩的文件；不超过small字节的文件读入内存缓存，其他的用sendfile发送
+class StaticFiles(object):
+    def __init__(self, root, prefix='/static/', small=64 * 1024, cache_size=256):
+        self.root = root
+        self.prefix = prefix
+        self.small = small
+        # 文件名 => 带hash的文件名
+        self._manifest = dict()
+        # url中的文件名(带或不带hash) => (StaticFile, 是否带hash)
+        self._files = dict()
+        # 路径 => (文件内容, 编码 => 压缩后的内容)
+        self._cache = LRUCache(cache_size)
+        self.scan()
+
+    def scan(self):
+        manifest, files = dict(), dict()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(('.gz', '.br')) and filename[:-3] in filenames:
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                encodings = dict((coding, path + ext) for coding, ext in (('br', '.br'), ('gzip', '.gz')) if os.path.isfile(path + ext))
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                st = os.stat(path)
+                f = StaticFile(path, content_type, self._digest(path), st.st_size, st.st_mtime, encodings)
+                base, ext = os.path.splitext(name)
+                hashed = '%s.%s%s' % (base, f.digest[:10], ext)
+                manifest[name] = hashed
+                files[name] = (f, False)
+                files[hashed] = (f, True)
+        self._manifest, self._files = manifest, files
+        self._cache.clear()
+        logging.info('add static %s => %s (%s files)' % (self.prefix, self.root, len(manifest)))
+
+    @staticmethod
+    def _digest(path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(65536), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # 模板中引用静态文件的url
+    def url(self, name):
+        return self.prefix + self._manifest.get(name.lstrip('/'), name.lstrip('/'))
+
+    async def handle(self, request):
+        item = self._files.get(request.match_info['filename'])
+        if item is None:
+            return web.HTTPNotFound()
+        f, immutable = item
+        headers = {'Cache-Control': 'public, max-age=31536000, immutable' if immutable else 'no-cache',
+            'Last-Modified': formatdate(f.mtime, usegmt=True)}
+        coding = accept_encoding(request, tuple(c for c in ('br', 'gzip') if c in f.encodings))
+        path = f.encodings[coding] if coding else f.path
+        if coding:
+            headers['Content-Encoding'] = coding
+        if f.encodings:
+            headers['Vary'] = 'Accept-Encoding'
+        headers['ETag'] = '"%s-%s"' % (f.digest, coding) if coding else '"%s"' % f.digest
+        if not_modified(request, CachedResponse(None, f.content_type, None, '"%s"' % f.digest, f.mtime, None)):
+            return web.HTTPNotModified(headers=headers)
+        size = os.path.getsize(path) if coding else f.size
+        if size > self.small:
+            headers['Content-Type'] = f.content_type
+            return web.FileResponse(path, headers=headers)
+        # 缓存文件内容和没有预压缩文件时压缩后的内容
+        item = self._cache.get(path)
+        if item is None:
+            item = (await asyncio.get_event_loop().run_in_executor(None, self._read, path), dict())
+            self._cache.set(path, item)
+        body, compressed = item
+        resp = web.Response(body=body, content_type=f.content_type, headers=headers)
+        return resp if coding else await compress_response(request, resp, compressed)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+# 用于注册静态文件（如image，css，javascript等），只提供文件路径即可进行注册
+# 返回StaticFiles，app['static_url']供模板得到带hash的url
+def add_static(app, path=None, prefix='/static/'):
+    # 当前文件夹的绝对路径与'static'拼接合成路径
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    files = StaticFiles(path, prefix)
+    app.router.add_route('GET', prefix + '{filename:.+}', files.handle)
+    app['static_url'] = files.url
+    return files
+    
+# 注册视图函数(添加路由)    
+def add_route(app, fn):
+    # 从fn中得到'__method__'属性值，若无则默认为空
+    method = getattr(fn, '__method__', None)
+    path = getattr(fn, '__route__', None)
+    if path is None or method is None:
+        raise ValueError('@get or @post not defined in %s.' % str(fn))
+    # 判断URL处理函数(视图函数)是否协程并且是生成器 
+    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
+        # 变为协程因为需要执行异步IO
+        fn = asyncio.coroutine(fn)
+    logging.info('add route %s %s =? %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    # 在app中注册经RequestHandler类封装(调用了__call__方法)的视图函数，
+    app.router.add_route(method, path, RequestHandler(app, fn))
+    
+# 导入模块路径以此批量注册视图函数
+def add_routes(app, module_name):
+    # rfind()从字符串右侧检测字符串中是否包含子字符串str即'.',若有返回其索引，无返回-1
+    n = module_name.rfind('.')
+    if n == (-1):
+        # __import__ 作用同import语句，但__import__是一个函数，并且只接收字符串作为参数  
+        # __import__('os',globals(),locals(),['path','pip'], 0) ,等价于from os import path, pip
+        # 由于后续的dir(mod)接收模块对象而不是字符串故需要import
+        mod = __import__(module_name, globals(), locals())
+    else:
+        # 选择从模块名的'.'的下一位开始直到最后的字符
+        name = module_name[n+1:]
+        # 只获取最终导入的模块名，为后续调用dir(). from (点号前面的字符) import name
+        # 得到module_name模块对象中，所需的name模块对象
+        mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
+    # 获取mod模块中所有类，实例及函数等对象(str形式)，返回list
+    for attr in dir(mod):
+        # 忽略以'_'开头的对象(一些内置属性等)
+        if attr.startswith('_'):
+            continue
+        fn = getattr(mod, attr)
+        # 确保是可被调用的(函数)
+        if callable(fn):
+            method = getattr(fn, '__method__', None)
+            path = getattr(fn, '__route__', None)
+            if method and path:
+                # 注册视图函数
+                add_route(app, fn)
         
-    # 导入模块路径以此批量注册视图函数
-    def add_routes(app, module_name):
-        # rfind()从字符串右侧检测字符串中是否包含子字符串str即'.',若有返回其索引，无返回-1
-        n = module_name.rfind('.')
-        if n == (-1):
-            # __import__ 作用同import语句，但__import__是一个函数，并且只接收字符串作为参数  
-            # __import__('os',globals(),locals(),['path','pip'], 0) ,等价于from os import path, pip
-            # 由于后续的dir(mod)接收模块对象而不是字符串故需要import
-            mod = __import__(module_name, globals(), locals())
-        else:
-            # 选择从模块名的'.'的下一位开始直到最后的字符
-            name = module_name[n+1:]
-            # 只获取最终导入的模块名，为后续调用dir(). from (点号前面的字符) import name
-            # 得到module_name模块对象中，所需的name模块对象
-            mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
-        # 获取mod模块中所有类，实例及函数等对象(str形式)，返回list
-        for attr in dir(mod):
-            # 忽略以'_'开头的对象(一些内置属性等)
-            if attr.startswith('_'):
-                continue
-            fn = getattr(mod, attr)
-            # 确保是可被调用的(函数)
-            if callable(fn):
-                method = getattr(fn, '__method__', None)
-                path = getattr(fn, '__route__', None)
-                if method and path:
-                    # 注册视图函数
-                    add_route(app, fn)
-            
 '''
 # 建立视图函数装饰器，用来存储、附带URL信息  
 def Handler_decorator(path, *, method):  
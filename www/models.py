@@ -3,48 +3,126 @@
 
 __author__ = 'lzh'
 
-import time, uuid
+import time, uuid, os, logging
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IdField, FloatField, TextField, CounterField, Counter, Snowflake, schema
+from orm import select, execute, execute_many, create_args_string
 
-def next_id():
+def uuid_id():
     # uuid生成机器唯一标识,uuid4()由伪随机数得到,有一定的重复概率,该概率可以计算出来。hex得到十六进制数
     # time.time()返回1970纪元后经过的浮点秒数，%015d指15位数，不足则前面补0
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+# 主键的生成方式，由环境变量ID_MODE选择：
+# uuid：原来的50位字符串主键，varchar(50)
+# snowflake：64位按时间递增的整数主键，bigint，主键和外键的索引小得多；已有的数据库先用migrate_ids()迁移
+#           超过JavaScript的2^53，API的JSON中输出为字符串，客户端原样传回即可
+ID_MODE = os.environ.get('ID_MODE', 'uuid')
+
+# 多进程部署时每个进程要设置不同的snowflake.worker_id
+snowflake = Snowflake(int(os.environ.get('WORKER_ID', os.getpid() % 1024)))
+
+next_id = snowflake.next_id if ID_MODE == 'snowflake' else uuid_id
+
+# 主键和外键列，类型随ID_MODE变化
+def id_field(primary_key=False, index=False):
+    default = next_id if primary_key else None
+    if ID_MODE == 'snowflake':
+        return IdField(primary_key=primary_key, default=default, index=index)
+    return StringField(primary_key=primary_key, default=default, ddl='varchar(50)', index=index)
     
 class User(Model):
     __table__ = 'users'
+    # 每个博客页面都要显示作者，按主键缓存最近的1000个用户60秒
+    __cache_size__ = 1000
+    __cache_ttl__ = 60
+    # 渲染评论列表时并发查询每条评论的作者，合并为一次查询
+    __batch_find__ = True
     
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True)
+    # 登录时按email查找
+    email = StringField(ddl='varchar(50)', index=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(50)')
+    # 由Blog的save/remove维护
+    blog_count = CounterField()
     created_at = FloatField(default=time.time)
     
 class Blog(Model):
     __table__ = 'blogs'
+    __counters__ = [Counter(User, 'blog_count', 'user_id')]
     
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True)
+    user_id = id_field(index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    # 由Comment的save/remove维护
+    comment_count = CounterField()
+    # 博客列表按created_at desc排序和分页，InnoDB的二级索引末尾带有主键，即(created_at, id)
+    created_at = FloatField(default=time.time, index=True)
     
 class Comment(Model):
     __table__ = 'comments'
+    __counters__ = [Counter(Blog, 'comment_count', 'blog_id')]
+    # 按博客列出评论时按时间排序
+    __indexes__ = [('blog_id', 'created_at')]
     
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True)
+    blog_id = id_field()
+    user_id = id_field(index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+# 旧的字符串主键的前15位是毫秒时间戳，与uuid部分的低22位组成snowflake整数
+# 主键和外键用同一个函数换算，不需要对照表，换算后仍按时间递增
+def legacy_to_snowflake(old_id):
+    if not old_id:
+        return None
+    return ((int(old_id[:15]) - Snowflake.EPOCH) << 22) | (int(old_id[15:47], 16) & 0x3fffff)
+
+# 把已有数据库的字符串主键和外键(*_id列)迁移为bigint，需在ID_MODE=uuid下运行，完成后改用ID_MODE=snowflake
+# 先为每个id列加一个bigint的新列并逐批回填，新主键没有重复时再删除旧列，把新列改名并重建主键和索引
+async def migrate_ids(models=None):
+    for model in models or (User, Blog, Comment):
+        table, pk = model.__table__, model.__primary_key__
+        columns = [pk] + [f for f in model.__fields__ if f.endswith('_id')]
+        await execute('alter table `%s` %s' % (table, ', '.join('add column `%s_new` bigint' % c for c in columns)), [])
+        sql = 'update `%s` set %s where `%s`=?' % (table, ', '.join('`%s_new`=?' % c for c in columns), pk)
+        async for rows in model.iterAll(only=columns, compact=True, chunks=True):
+            await execute_many(sql, [[legacy_to_snowflake(getattr(r, c)) for c in columns] + [getattr(r, pk)] for r in rows])
+        # legacy_to_snowflake只保留22位随机数，两个旧主键可能换算为同一个值；删除旧列前检查，有重复则删掉新列并中止，旧列保持不变
+        rs = await select('select `%s_new` _id_ from `%s` group by `%s_new` having count(*)>1' % (pk, table, pk), [], 10)
+        if rs:
+            await execute('alter table `%s` %s' % (table, ', '.join('drop column `%s_new`' % c for c in columns)), [])
+            raise RuntimeError('duplicate snowflake ids in %s: %s' % (table, ', '.join(str(r['_id_']) for r in rs)))
+        # MySQL删除列时只把它从组合索引中去掉，组合索引仍然存在，之后重建同名索引会失败，所以先删除涉及这些列的索引
+        rs = await select('select distinct `index_name` _name_ from information_schema.statistics where `table_schema`=database() '
+            'and `table_name`=? and `index_name`<>? and `column_name` in (%s)' % create_args_string(len(columns)), [table, 'PRIMARY'] + columns)
+        if rs:
+            await execute('alter table `%s` %s' % (table, ', '.join('drop index `%s`' % r['_name_'] for r in rs)), [])
+        declared = set('idx_%s_%s' % (table, '_'.join(index)) for index in model.__indexes__)
+        for r in rs:
+            if r['_name_'] not in declared:
+                logging.warning('index %s on %s is not declared in __indexes__ and will not be recreated' % (r['_name_'], table))
+        await execute('alter table `%s` drop primary key, %s' % (table, ', '.join('drop column `%s`' % c for c in columns)), [])
+        await execute('alter table `%s` %s, add primary key (`%s`)' % (table,
+            ', '.join('change column `%s_new` `%s` bigint%s' % (c, c, ' not null' if c == pk else '') for c in columns), pk), [])
+        # 按__indexes__重建涉及这些列的索引
+        for index in model.__indexes__:
+            if set(index) & set(columns):
+                await execute('create index `idx_%s_%s` on `%s` (%s)' % (table, '_'.join(index), table,
+                    ', '.join('`%s`' % f for f in index)), [])
+
+# 输出建表语句：python3 models.py > schema.sql
+if __name__ == '__main__':
+    print(schema(User, Blog, Comment))
     
 '''
 创建博客所需的三个数据库
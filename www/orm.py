@@ -5,20 +5,255 @@ __author__ = 'lzh'
 
 #import sys, random
 
-import asyncio, logging
+import asyncio, logging, time, collections, json, base64, contextvars, contextlib, functools, weakref, re
 import aiomysql 
 
-# 打印用户所使用的sql语句
+# 打印用户所使用的sql语句，只在DEBUG级别输出，线上只记录慢查询
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s' % sql)
+
+# 执行时间超过slow_query秒的语句记为慢查询
+__slow_query = 0.5
+# 是否保留每种语句最近一次的参数供explain_queries()使用，参数中可能有email，passwd等，默认不保留
+__sample_args = False
+# 每条sql模板(带?占位符的语句)的执行次数，总耗时和最大耗时
+__query_stats = dict()
+
+# 记录一条语句的执行时间，超过阈值时输出慢查询日志
+def record_query(sql, args, elapsed):
+    stat = __query_stats.get(sql)
+    if stat is None:
+        # 模板数量有上限，避免拼接了值的sql让统计无限增长
+        if len(__query_stats) >= 1000:
+            stat = [0, 0.0, 0.0, None]
+        else:
+            stat = __query_stats[sql] = [0, 0.0, 0.0, None]
+    stat[0] += 1
+    stat[1] += elapsed
+    stat[2] = max(stat[2], elapsed)
+    # 保留最近一次的参数，explain_queries()用它来EXPLAIN
+    if __sample_args:
+        stat[3] = args
+    # 只输出sql模板和耗时，不输出参数
+    if elapsed >= __slow_query:
+        logging.warning('slow query (%.3fs): %s' % (elapsed, sql))
+
+# 按sql模板返回执行次数，总耗时，平均耗时，最大耗时(秒)
+def query_stats():
+    return dict((sql, dict(count=n, total=total, avg=total / n, max=m)) for sql, (n, total, m, args) in __query_stats.items() if n)
+
+# 修改慢查询的阈值(秒)
+def set_slow_query(seconds):
+    global __slow_query
+    __slow_query = seconds
 
 # 创建连接池会事先限定连接数量，不必频繁地打开和关闭数据库连接，**kw任意个关键字参数即dict
+# replicas为只读副本的list，每个元素是一个dict，没有给出的参数(如user，password，db)与主库相同
+# select，find，findAll，findNumber发往副本，execute和事务中的语句发往主库
+# 写入后read_your_writes秒内的读也发往主库，避免副本延迟导致读不到刚写入的数据
+# slow_query为慢查询日志的阈值(秒)；sample_args=True时保留每种语句最近一次的参数，explain_queries()才能EXPLAIN带?的语句
+# 过载保护：等待借连接的协程超过max_waiters个，或等待超过acquire_timeout秒时抛出PoolExhaustedError
+# 语句执行超过query_timeout秒时取消并抛出QueryTimeoutError，同时用KILL QUERY终止MySQL中的语句(默认不限制)
+# 连接的回收：空闲超过idle_timeout秒或建立超过max_age秒的连接被关闭，避免用到已被MySQL断开的连接
+# 启动时预先建立warm个连接；adaptive=True时每adapt_interval秒关闭超出观察到的并发量的空闲连接(不少于minsize)
 async def create_pool(loop, **kw): 
 	logging.info('create database connection pool...')
     # 加了两个下划线能使变量不被外部访问
-	global __pool 
+	global __pool, __replicas, __read_your_writes, __query_timeout, __sample_args
+	limits = dict(max_waiters=kw.get('max_waiters', kw.get('maxsize', 10) * 10), acquire_timeout=kw.get('acquire_timeout', 5.0),
+		max_age=kw.get('max_age', None))
+	__pool = Pool('primary', await connect_pool(loop, **kw), **limits)
+	__replicas = []
+	for replica in kw.get('replicas', []):
+		name = replica.get('host', 'localhost')
+		logging.info('create replica connection pool: %s...' % name)
+		__replicas.append(Pool(name, await connect_pool(loop, **dict(kw, **replica)), **limits))
+	for pool in [__pool] + __replicas:
+		await pool.warm(kw.get('warm', 0))
+		if kw.get('adaptive', False):
+			pool.start(kw.get('adapt_interval', 10.0))
+	__read_your_writes = kw.get('read_your_writes', 1.0)
+	__query_timeout = kw.get('query_timeout', None)
+	set_slow_query(kw.get('slow_query', 0.5))
+	__sample_args = kw.get('sample_args', False)
+
+# 数据库暂时无法处理请求，retry_after为建议客户端等待后重试的秒数，RequestHandler把它转换为503
+class DatabaseBusyError(Exception):
+    def __init__(self, message, retry_after=1):
+        super(DatabaseBusyError, self).__init__(message)
+        self.retry_after = retry_after
+
+# 等待借连接的协程太多或等待超时
+class PoolExhaustedError(DatabaseBusyError):
+    pass
+
+# 语句执行超时
+class QueryTimeoutError(DatabaseBusyError):
+    pass
+
+# 语句默认的执行超时时间(秒)，None为不限制
+__query_timeout = None
+
+# 在conn上执行aw(执行语句并读取结果的协程)，超过timeout秒则取消
+# 取消后连接上的状态已不可知，关闭连接，归还时连接池会丢弃它
+# 关闭客户端的连接并不会停止MySQL中正在执行的语句，再从同一个连接池借一个连接用KILL QUERY终止它
+async def with_timeout(conn, aw, timeout=None):
+    timeout = timeout or __query_timeout
+    if not timeout:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        thread_id = conn.thread_id()
+        conn.close()
+        for pool in [__pool] + __replicas:
+            if conn in pool._born:
+                # 这个连接归还后才可能有空闲连接，不在这里等待
+                detached(pool.kill(thread_id))
+        raise QueryTimeoutError('query timeout after %ss' % timeout)
+
+# 包装aiomysql的连接池，统计借连接的等待时间，连接被占用的时间，以及使用中和空闲的连接数
+class Pool(object):
+    def __init__(self, name, pool, max_waiters=None, acquire_timeout=None, max_age=None):
+        self.name = name
+        self.pool = pool
+        self.max_waiters = max_waiters
+        self.acquire_timeout = acquire_timeout
+        self.max_age = max_age
+        # 连接第一次被借出的时间，用于按max_age回收
+        self._born = weakref.WeakKeyDictionary()
+        # 正在使用的连接数，以及上次自适应调整以来的峰值
+        self.in_use = 0
+        self._peak = 0
+        # 上次自适应调整时的(借出次数, 累计等待时间)
+        self._window = (0, 0.0)
+        self._task = None
+        # 因过载被拒绝的次数
+        self.rejected = 0
+        # 正在等待借连接的协程数
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    @property
+    def freesize(self):
+        return self.pool.freesize
+
+    # async with pool.get() as conn: 借出一个连接，结束时归还
+    @contextlib.asynccontextmanager
+    async def get(self):
+        start = time.monotonic()
+        # 等待队列已满时直接拒绝，不再无限排队
+        if self.max_waiters is not None and self.waiting >= self.max_waiters and self.freesize == 0:
+            self.rejected += 1
+            raise PoolExhaustedError('too many waiters for connection pool %s: %s' % (self.name, self.waiting))
+        self.waiting += 1
+        try:
+            conn = await asyncio.wait_for(self.pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PoolExhaustedError('timeout acquiring connection from pool %s after %ss' % (self.name, self.acquire_timeout))
+        finally:
+            self.waiting -= 1
+        acquired = time.monotonic()
+        self.acquired += 1
+        self.wait_total += acquired - start
+        self.wait_max = max(self.wait_max, acquired - start)
+        self.in_use += 1
+        self._peak = max(self._peak, self.in_use)
+        born = self._born.setdefault(conn, acquired)
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            # 超过max_age的连接关闭后归还，连接池会丢弃它，下次需要时重新建立
+            if self.max_age and acquired - born > self.max_age:
+                conn.close()
+            self.pool.release(conn)
+            hold = time.monotonic() - acquired
+            self.hold_total += hold
+            self.hold_max = max(self.hold_max, hold)
+
+    # 终止MySQL中thread_id连接正在执行的语句
+    async def kill(self, thread_id):
+        try:
+            async with self.get() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('KILL QUERY %d' % thread_id)
+        except Exception as e:
+            logging.warning('failed to kill query on %s thread %s: %s' % (self.name, thread_id, e))
+
+    # 预先建立连接，使连接池中至少有n个连接(不超过maxsize)
+    async def warm(self, n):
+        n = min(n, self.pool.maxsize) - self.size
+        if n <= 0:
+            return
+        conns = await asyncio.gather(*[self.pool.acquire() for i in range(n)], return_exceptions=True)
+        for conn in conns:
+            if not isinstance(conn, BaseException):
+                self.pool.release(conn)
+
+    # 关闭n个空闲连接，aiomysql先借出最久未使用的连接
+    async def trim(self, n):
+        for i in range(n):
+            if self.freesize == 0:
+                break
+            conn = await self.pool.acquire()
+            conn.close()
+            self.pool.release(conn)
+
+    # 自适应调整：aiomysql在没有空闲连接且未到maxsize时会自己建立新连接，增加连接不需要这里处理；
+    # 这里只关闭多余的空闲连接，保留这段时间内同时使用的峰值加headroom个，已到maxsize还需要等待时输出警告
+    async def adapt(self, interval, headroom=2):
+        while True:
+            await asyncio.sleep(interval)
+            acquired, waited = self.acquired - self._window[0], self.wait_total - self._window[1]
+            self._window = (self.acquired, self.wait_total)
+            peak, self._peak = self._peak, self.in_use
+            if acquired and waited / acquired > 0.005 and self.size >= self.pool.maxsize:
+                logging.warning('connection pool %s is at maxsize %s, avg wait %.3fs' % (self.name, self.pool.maxsize, waited / acquired))
+            target = max(self.pool.minsize, peak + headroom)
+            if self.size > target:
+                await self.trim(self.size - target)
+
+    def start(self, interval):
+        self._task = asyncio.ensure_future(self.adapt(interval))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    def stats(self):
+        n = self.acquired or 1
+        return dict(name=self.name, size=self.size, free=self.freesize, in_use=self.size - self.freesize,
+            maxsize=self.pool.maxsize, waiting=self.waiting, acquired=self.acquired, rejected=self.rejected,
+            wait_avg=self.wait_total / n, wait_max=self.wait_max, hold_avg=self.hold_total / n, hold_max=self.hold_max)
+
+# 主库和各副本连接池的统计
+def pool_stats():
+    return [p.stats() for p in [__pool] + __replicas]
+
+# 只读副本的连接池
+__replicas = []
+# 当前上下文(一个请求及其创建的task)上一次写入主库的时间，以及写入后读操作仍留在主库的秒数
+# 只影响写入的那个请求，其他请求的读照常发往副本
+__last_write = contextvars.ContextVar('last_write', default=0.0)
+__read_your_writes = 1.0
+__next_replica = 0
+
+# 按参数创建一个aiomysql连接池
+async def connect_pool(loop, **kw):
 	# 以下都是连接数据库所需的参数
-	__pool = await aiomysql.create_pool( 
+	return await aiomysql.create_pool( 
 		# get(a,b)在dict中找出与a对应的值，若找不到则默认b
 		host=kw.get('host', 'localhost'),
 		port=kw.get('port', 3306),
@@ -33,10 +268,33 @@ async def create_pool(loop, **kw):
 		maxsize=kw.get('maxsize', 10), 
         # 最小连接数:连接池一直保持的数据库连接,所以如果应用程序对数据库连接的使用量不大,将会有大量的数据库连接资源被浪费.
 		minsize=kw.get('minsize', 1),
+        # 空闲超过多少秒的连接在下次借出前关闭并重新建立，-1为不限制，应小于MySQL的wait_timeout
+		pool_recycle=kw.get('idle_timeout', -1),
         # Eventloop协程，即异步事件
 		loop=loop
 	)
+
+# 关闭主库和副本的连接池：先写入WriteBehind中积累的更新，停止自适应调整，等借出的连接都归还后关闭
+async def close_pool():
+    for queue in list(WriteBehind.instances):
+        await queue.close()
+    for pool in [__pool] + __replicas:
+        await pool.close()
     
+# 对执行过的每种select语句(用最近一次的参数)执行EXPLAIN，找出全表扫描(type为ALL)的语句
+# 带?的语句需要create_pool(sample_args=True)保留的参数，没有参数的跳过
+# 返回[(sql, 表名, 估计扫描的行数)]，同时输出警告日志
+async def explain_queries():
+    scans = []
+    for sql, stat in list(__query_stats.items()):
+        if not sql.lower().startswith('select') or ('?' in sql and stat[3] is None):
+            continue
+        for r in await select('explain ' + sql, stat[3] or []):
+            if r.get('type') == 'ALL':
+                logging.warning('full table scan on %s (%s rows): %s' % (r.get('table'), r.get('rows'), sql))
+                scans.append((sql, r.get('table'), r.get('rows')))
+    return scans
+
 '''关闭数据库在测试时需要
 async def destory_pool():
     global __pool
@@ -45,6 +303,104 @@ async def destory_pool():
         await __pool.wait_closed()    
 '''
   
+# 当前上下文(协程及其创建的task)中由connection()或transaction()借出的连接
+__scoped = contextvars.ContextVar('scoped_connection', default=None)
+
+# 被同一上下文共用的连接，lock保证同一时刻只有一个协程在这个连接上执行语句(如asyncio.gather并发的查询)
+class ScopedConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        self.in_transaction = False
+        # 事务中写入过的表，提交时再通知一次
+        self.written = set()
+
+# 在async with orm.connection():中的select，execute及Model的方法都使用同一个连接，不再每条语句借还一次
+@contextlib.asynccontextmanager
+async def connection():
+    scoped = __scoped.get()
+    if scoped is not None:
+        yield scoped.conn
+        return
+    async with __pool.get() as conn:
+        token = __scoped.set(ScopedConnection(conn))
+        try:
+            yield conn
+        finally:
+            __scoped.reset(token)
+
+# 在async with orm.transaction():中的所有语句在同一个事务中执行，正常结束时一起提交，发生异常则全部回滚
+# 嵌套使用时并入最外层的事务
+@contextlib.asynccontextmanager
+async def transaction():
+    scoped = __scoped.get()
+    if scoped is not None and scoped.in_transaction:
+        yield scoped.conn
+        return
+    async with connection() as conn:
+        scoped = __scoped.get()
+        async with scoped.lock:
+            await conn.begin()
+        scoped.in_transaction = True
+        try:
+            yield conn
+            async with scoped.lock:
+                await conn.commit()
+            mark_write()
+            # 事务进行中其他协程可能又把提交前的数据放进了缓存
+            notify_write(*scoped.written)
+        except BaseException as e:
+            async with scoped.lock:
+                if not conn.closed:
+                    await conn.rollback()
+            raise
+        finally:
+            scoped.in_transaction = False
+            scoped.written.clear()
+
+def in_transaction():
+    scoped = __scoped.get()
+    return scoped is not None and scoped.in_transaction
+
+# 在空的上下文中运行的task：不继承调用者connection()/transaction()借出的连接
+def detached(coro):
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+# 选择一个副本：优先选正在使用的连接最少的，一样多时轮流选
+def choose_replica():
+    global __next_replica
+    n = len(__replicas)
+    __next_replica = (__next_replica + 1) % n
+    candidates = [__replicas[(__next_replica + i) % n] for i in range(n)]
+    return min(candidates, key=lambda p: p.size - p.freesize)
+
+# 只读语句使用的连接池：没有副本或刚写入过时用主库
+def read_pool():
+    if __replicas and time.monotonic() - __last_write.get() >= __read_your_writes:
+        return choose_replica()
+    return __pool
+
+# 记录当前上下文写入主库的时间，之后一小段时间内这个上下文的读也发往主库
+def mark_write():
+    __last_write.set(time.monotonic())
+
+# 得到执行语句用的连接：有connection()/transaction()借出的连接就用它(总在主库上)，否则从连接池中借一个，用完归还
+# readonly为True时从副本的连接池中借
+@contextlib.asynccontextmanager
+async def acquire(readonly=False):
+    scoped = __scoped.get()
+    if scoped is not None:
+        async with scoped.lock:
+            yield scoped.conn
+    else:
+        async with (read_pool() if readonly else __pool).get() as conn:
+            yield conn
+
+# 将sql的占位符'?'替换为MySQL的占位符'%s'，同一条语句只替换一次，之后直接查表
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    return sql.replace('?', '%s')
+
 # 返回元类中创建sql_insert语句中的占位符
 def create_args_string(num):
     L = []
@@ -54,55 +410,504 @@ def create_args_string(num):
     return ', '.join(L) 
     
 # 封装select语句，返回选择的结果集，结果集是一个list，其中每个元素都是一个dict
-async def select(sql, args, size=None):
+# cursorclass为aiomysql.Cursor时每个元素是一个tuple
+# timeout为这条语句的执行超时时间(秒)，默认使用create_pool的query_timeout
+async def select(sql, args, size=None, cursorclass=aiomysql.DictCursor, timeout=None):
     # 打印查询语句
     log(sql, args) 
-    global __pool
-    # 把__pool.get()调用__enter__()后的返回值赋值给conn
+    # 把acquire()调用__aenter__()后的返回值赋值给conn
     # 类似conn = mysql.connector.connect(user='root', password='password', database='test')
-    async with __pool.get() as conn:
+    async with acquire(readonly=True) as conn:
         # 创建cursor(游标)对象，数据库的操作由它执行,aiomysql.DictCursor将查询后的返回值变为dict格式，
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # 执行查询语句，将sql的占位符'?'由MySQL的占位符'%s'替代，替换的参数为args或空
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            # 将查询后的结果集按照size的数量返回或全部返回
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await cur.fetchall()
-        logging.info('row returned: %s' % len(rs))
+        async with conn.cursor(cursorclass) as cur:
+            async def query():
+                # 执行查询语句，将sql的占位符'?'由MySQL的占位符'%s'替代，替换的参数为args或空
+                await cur.execute(translate(sql), args or ())
+                # 将查询后的结果集按照size的数量返回或全部返回
+                if size:
+                    return await cur.fetchmany(size)
+                return await cur.fetchall()
+            start = time.monotonic()
+            rs = await with_timeout(conn, query(), timeout)
+            record_query(sql, args, time.monotonic() - start)
+        logging.debug('row returned: %s' % len(rs))
         return rs
         
+# 用服务端游标(SSDictCursor，不缓冲结果集)逐批读取，每次yield一个最多chunk_size行的list，内存占用与表的大小无关
+# 迭代期间一直占用同一个连接，提前break时关闭游标会丢弃剩余的行
+# 不在事务中时单独借一个连接，在事务中时使用事务的连接，此时迭代过程中不能再执行其他语句
+async def select_iter(sql, args, chunk_size=1000, cursorclass=aiomysql.SSDictCursor):
+    log(sql, args)
+    async with (acquire() if in_transaction() else read_pool().get()) as conn:
+        async with conn.cursor(cursorclass) as cur:
+            start = time.monotonic()
+            await with_timeout(conn, cur.execute(translate(sql), args or ()))
+            # 只统计到开始返回结果为止的时间
+            record_query(sql, args, time.monotonic() - start)
+            while True:
+                rs = await cur.fetchmany(chunk_size)
+                if not rs:
+                    break
+                yield rs
+        
+# 表被写入时的回调：表名 => [callback(table)]，用于使依赖这个表的缓存失效
+__write_listeners = collections.defaultdict(list)
+
+def on_table_write(table, callback):
+    __write_listeners[table].append(callback)
+
+# 通知这些表被写入了，在transaction()中时提交后会再通知一次
+def notify_write(*tables):
+    scoped = __scoped.get()
+    if scoped is not None and scoped.in_transaction:
+        scoped.written.update(tables)
+    for table in tables:
+        for callback in __write_listeners.get(table, ()):
+            callback(table)
+
+# 从写语句中取出被写入的表名
+__write_table = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update(?:\s+ignore)?|delete\s+from|'
+    r'alter\s+table|truncate(?:\s+table)?|drop\s+table)\s+`?(\w+)`?', re.IGNORECASE)
+
+def written_table(sql):
+    m = __write_table.match(sql)
+    return m.group(1) if m else None
+
 # 封装insert，update，delete操作，返回影响的行数，autocommit自动提交事务默认为True
-async def execute(sql, args, autocommit=True): 
+async def execute(sql, args, autocommit=True, timeout=None): 
     log(sql)
-    async with __pool.get() as conn: 
+    # 已在transaction()中时由外层事务负责提交或回滚
+    if in_transaction():
+        autocommit = True
+    async with acquire() as conn: 
         # 若不是自动提交事务则开始执行事务
         if not autocommit:
             await conn.begin()
         try:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+                start = time.monotonic()
+                await with_timeout(conn, cur.execute(translate(sql), args), timeout)
+                record_query(sql, args, time.monotonic() - start)
                 # cur.rowcount是execute()影响的行数
                 affected = cur.rowcount 
             # 如果不是自动提交事务则需commit()
             if not autocommit:
                 await conn.commit() 
         except BaseException as e:
-            if not autocommit:
+            # 超时的连接已被关闭，不能再回滚
+            if not autocommit and not conn.closed:
                 # 回滚到事务开始前，事务占用资源被释放
                 await conn.rollback() 
             # 抛出本身的错误即BaseException
             raise 
+        finally:
+            mark_write()
+        notify_write(written_table(sql))
         return affected
-    
-# user定义每一列的名字，类型，是否为主键，默认值
+
+# 批量执行同一条insert，update，delete语句，args_list的每个元素是一行的参数
+# 所有批次共用一个连接，每batch_size行交给executemany发送一次，返回每一批影响的行数组成的list
+async def execute_many(sql, args_list, batch_size=1000, autocommit=True):
+    log(sql)
+    args_list = list(args_list)
+    counts = []
+    if in_transaction():
+        autocommit = True
+    async with acquire() as conn:
+        if not autocommit:
+            await conn.begin()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                for i in range(0, len(args_list), batch_size):
+                    # aiomysql会把insert ... values (...)的executemany合并为一条多行VALUES语句
+                    start = time.monotonic()
+                    await with_timeout(conn, cur.executemany(translate(sql), args_list[i:i + batch_size]))
+                    record_query(sql, '%s rows' % len(args_list[i:i + batch_size]), time.monotonic() - start)
+                    counts.append(cur.rowcount)
+            if not autocommit:
+                await conn.commit()
+        except BaseException as e:
+            if not autocommit and not conn.closed:
+                await conn.rollback()
+            raise
+        finally:
+            mark_write()
+        notify_write(written_table(sql))
+        return counts
+
+# 键集分页的游标：把上一页最后一行的(排序列的值, 主键)编码为不透明的字符串，调用者原样传回即可
+def encode_cursor(value, pk):
+    return base64.urlsafe_b64encode(json.dumps([value, pk]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return value, pk
+
+# 带容量上限和过期时间(秒)的LRU缓存，记录命中、未命中和淘汰次数，便于估算合适的容量
+class LRUCache(object):
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # OrderedDict按访问顺序保存(value, 过期时间)，最久未使用的在最前面
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires = item
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            # 已过期则删除，按未命中处理
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    # ttl为这一项的过期时间，默认使用缓存的ttl
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        self._evict()
+
+    # 超出容量时淘汰最久未使用的项
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+# 查询结果缓存：按(sql, args)缓存select得到的行，总行数超过max_rows时淘汰最久未使用的项
+# 同一个key同时只有一个协程查询数据库，其他协程等待它的结果，避免缓存失效的瞬间大量相同的查询同时打到数据库
+# 由Model的元类按表注册为写入回调，表被写入时清空；查询过程中表被写入的，查询结果不放入缓存
+class QueryCache(LRUCache):
+    def __init__(self, max_rows=10000, ttl=None):
+        super(QueryCache, self).__init__(max_rows, ttl)
+        self.rows = 0
+        # key => 正在查询的future
+        self._inflight = dict()
+        # 每次清空加一，用来判断查询过程中是否被清空过
+        self._generation = 0
+
+    async def fetch(self, key, query):
+        rs = self.get(key)
+        if rs is not None:
+            return rs
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # shield：等待的协程被取消时不影响正在进行的查询
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # 正在查询的协程被取消了，不是这个协程被取消：重新查询
+                if not fut.cancelled():
+                    raise
+                return await self.fetch(key, query)
+        fut = self._inflight[key] = asyncio.get_event_loop().create_future()
+        generation = self._generation
+        try:
+            rs = await query()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # 没有其他协程等待时避免asyncio报告异常未被取出
+            fut.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        if generation == self._generation:
+            self.set(key, rs)
+        fut.set_result(rs)
+        return rs
+
+    def set(self, key, value, ttl=None):
+        self.pop(key)
+        self.rows += self._cost(value)
+        super(QueryCache, self).set(key, value, ttl)
+
+    # 一项占用的行数，空结果也算一行，否则查询条件来自请求参数时空结果会无限增多
+    @staticmethod
+    def _cost(value):
+        return max(1, len(value))
+
+    # 按行数而不是项数限制容量，一项的行数超过上限时不缓存
+    def _evict(self):
+        while self.rows > self.maxsize and self._data:
+            self.rows -= self._cost(self._data.popitem(last=False)[1][0])
+            self.evictions += 1
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.rows -= self._cost(item[0])
+
+    def clear(self, table=None):
+        self._data.clear()
+        self.rows = 0
+        self._generation += 1
+
+    def stats(self):
+        return dict(super(QueryCache, self).stats(), rows=self.rows)
+
+# 把同一轮事件循环中并发的find(pk)收集起来，用一次findMany查询回答(DataLoader)
+# 例如asyncio.gather(*[User.find(c.user_id) for c in comments])只会查询一次数据库
+class BatchLoader(object):
+    def __init__(self, model):
+        self._model = model
+        # 主键 => 等待该主键结果的future的list
+        self._pending = collections.OrderedDict()
+        self._scheduled = False
+
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(pk, []).append(fut)
+        # 本轮第一个请求时安排在下一轮统一查询，这一轮中其他协程的find都会被收集进来
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._dispatch)
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, collections.OrderedDict()
+        self._scheduled = False
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            rs = await self._model.findMany(list(pending.keys()))
+        except BaseException as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            raise
+        for r, futs in zip(rs, pending.values()):
+            for i, fut in enumerate(futs):
+                if not fut.done():
+                    # 同一主键的多个调用者各自得到一个实例
+                    fut.set_result(r if i == 0 or r is None else self._model._fromRow(dict(r)))
+
+# 反范式的计数：子表的行save/remove时，在同一事务中把父表对应行的计数列加减，列表页直接读取计数不必count(*)
+# 例如Comment中__counters__ = [Counter(Blog, 'comment_count', 'blog_id')]，父表的计数列用CounterField定义
+class Counter(object):
+    def __init__(self, model, column, foreign_key):
+        self.model = model
+        self.column = column
+        self.foreign_key = foreign_key
+        self.sql = 'update `%s` set `%s`=`%s`+? where `%s`=?' % (model.__table__, column, column, model.__primary_key__)
+
+    async def incr(self, pk, n=1):
+        if pk is None or n == 0:
+            return
+        await execute(self.sql, [n, pk])
+        # 父表这一行的缓存失效
+        if self.model.__cache__ is not None:
+            self.model.__cache__.pop(pk)
+
+    # 用count(*)重新计算所有行的计数，修正直接用sql修改子表等造成的不一致
+    async def reconcile(self, child):
+        rows = await execute('update `%s` p set `%s`=(select count(*) from `%s` c where c.`%s`=p.`%s`)' % (
+            self.model.__table__, self.column, child.__table__, self.foreign_key, self.model.__primary_key__), [])
+        if self.model.__cache__ is not None:
+            self.model.__cache__.clear()
+        return rows
+
+# 写回队列：浏览数、最后访问时间这类频繁而不要求立即落库的更新先在内存中合并，请求不再等待写入
+# incr对同一行同一列的增量相加，set对同一行同一列只保留最后一次的值；每interval秒或积累max_pending行后批量写入，
+# 同一列的更新合并为一条update ... case语句，例如：
+# views = orm.WriteBehind(); views.start()
+# views.incr(Blog, 'read_count', blog.id)
+# close_pool()时会写入还没写入的更新；进程异常退出时未写入的更新会丢失
+class WriteBehind(object):
+    # 已start的队列，由close_pool()关闭
+    instances = []
+
+    def __init__(self, interval=1.0, max_pending=1000, batch_size=500, max_retries=3):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        # (model, 列名, 是否为增量) => OrderedDict(主键 => 增量或值)
+        self._pending = collections.OrderedDict()
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+        # 积累到max_pending时安排的写入
+        self._flushing = None
+        # (model, 列名, 是否为增量) => 连续写入失败的次数
+        self._failures = dict()
+        # 连续失败max_retries次后放弃写入的批次：[(model, 列名, 是否为增量, [(主键, 增量或值)])]
+        self.failed = []
+        # 调用incr/set的次数，写入的行数和执行的语句数
+        self.calls = 0
+        self.rows = 0
+        self.statements = 0
+
+    def incr(self, model, column, pk, n=1):
+        self._add(model, column, True, pk, n)
+
+    def set(self, model, column, pk, value):
+        self._add(model, column, False, pk, value)
+
+    def _add(self, model, column, incr, pk, value):
+        if column not in model.__mappings__ or column == model.__primary_key__:
+            raise ValueError('Invalid column for %s: %s' % (model.__name__, column))
+        self.calls += 1
+        self._merge(model, column, incr, pk, value)
+        # 积累太多时不等定时器，马上写入；已经安排了的不再重复安排
+        if self._size >= self.max_pending and not self._lock.locked() and (self._flushing is None or self._flushing.done()):
+            self._flushing = detached(self.flush())
+
+    # 合并进队列，new为True时(写入失败放回队列)不覆盖之后set的值
+    def _merge(self, model, column, incr, pk, value, new=True):
+        values = self._pending.setdefault((model, column, incr), collections.OrderedDict())
+        if pk not in values:
+            self._size += 1
+            values[pk] = value
+        elif incr:
+            values[pk] += value
+        elif new:
+            values[pk] = value
+
+    def start(self):
+        if self._task is None:
+            self._task = detached(self._run())
+            WriteBehind.instances.append(self)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception('write behind flush failed: %s' % e)
+
+    # 写入积累的更新，在没有connection()/transaction()的上下文中执行，不会并入调用者的事务
+    async def flush(self):
+        await detached(self._flush())
+
+    # 写入失败时把这一批及之后还没写入的更新放回队列，下次再写；同一列连续失败max_retries次的一批放入failed，不再阻塞之后的更新
+    async def _flush(self):
+        async with self._lock:
+            pending, self._pending, self._size = self._pending, collections.OrderedDict(), 0
+            while pending:
+                (model, column, incr), values = pending.popitem(last=False)
+                while values:
+                    batch = [values.popitem(last=False) for i in range(min(self.batch_size, len(values)))]
+                    key = (model, column, incr)
+                    try:
+                        await self._write(model, column, incr, batch)
+                        self._failures.pop(key, None)
+                    except Exception as e:
+                        self._failures[key] = self._failures.get(key, 0) + 1
+                        if self._failures[key] < self.max_retries:
+                            self._requeue(pending, key, values, batch)
+                            raise
+                        logging.error('write behind gave up %s rows of %s.%s after %s failures: %s' % (
+                            len(batch), model.__table__, column, self._failures.pop(key), e))
+                        self.failed.append((model, column, incr, batch))
+                    except BaseException as e:
+                        self._requeue(pending, key, values, batch)
+                        raise
+
+    # 把失败的一批和之后还没写入的更新放回队列
+    def _requeue(self, pending, key, values, batch):
+        values.update(batch)
+        pending[key] = values
+        pending.move_to_end(key, last=False)
+        for (model, column, incr), values in pending.items():
+            for pk, value in values.items():
+                self._merge(model, column, incr, pk, value, new=False)
+
+    async def _write(self, model, column, incr, items):
+        pk = model.__primary_key__
+        value = '`%s` + case' % column if incr else 'case'
+        sql = 'update `%s` set `%s` = %s `%s` %s end where `%s` in (%s)' % (model.__table__, column, value, pk,
+            ' '.join(['when ? then ?'] * len(items)), pk, create_args_string(len(items)))
+        args = [a for item in items for a in item] + [item[0] for item in items]
+        await execute(sql, args)
+        self.rows += len(items)
+        self.statements += 1
+        if model.__cache__ is not None:
+            for item in items:
+                model.__cache__.pop(item[0])
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            WriteBehind.instances.remove(self)
+        await self.flush()
+
+    def stats(self):
+        return dict(pending=self._size, calls=self.calls, rows=self.rows, statements=self.statements,
+            failed=sum(len(f[3]) for f in self.failed))
+
+# Snowflake主键：64位整数 = 41位毫秒时间戳(从EPOCH起) + 10位worker id + 12位序号，按时间递增
+# 每个进程必须使用不同的worker id(0~1023)，进程内同一毫秒用序号区分
+class Snowflake(object):
+    # 2015-01-01 00:00:00 UTC
+    EPOCH = 1420070400000
+
+    def __init__(self, worker_id=0):
+        self.worker_id = worker_id
+        self._last = -1
+        self._sequence = 0
+
+    @property
+    def worker_id(self):
+        return self._worker_id
+
+    @worker_id.setter
+    def worker_id(self, worker_id):
+        if not 0 <= worker_id < 1024:
+            raise ValueError('Invalid worker id: %s' % worker_id)
+        self._worker_id = worker_id
+
+    def next_id(self):
+        # 时钟回拨时沿用上一次的时间戳，保证生成的id单调递增
+        now = max(int(time.time() * 1000), self._last)
+        if now == self._last:
+            self._sequence = (self._sequence + 1) & 0xfff
+            # 这一毫秒的4096个序号用完，借用下一毫秒
+            if self._sequence == 0:
+                now = self._last + 1
+        else:
+            self._sequence = 0
+        self._last = now
+        return ((now - self.EPOCH) << 22) | (self._worker_id << 12) | self._sequence
+
+# user定义每一列的名字，类型，是否为主键，默认值，是否建立索引
 class Field(object):
-	def __init__(self, name, column_type, primary_key, default):
+	def __init__(self, name, column_type, primary_key, default, index=False):
 			self.name = name
 			self.column_type = column_type
 			self.primary_key = primary_key
 			self.default = default
+			self.index = index
+
+    # 把外部传入的值(如url或JSON中的主键)转换为这一列的类型，默认不转换
+	def convert(self, value):
+			return value
 
     # 打印类名(表名)，数据类型，属性名        
 	def __str__(self):
@@ -110,29 +915,66 @@ class Field(object):
             
 # 定义字符类型
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-    	super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False):
+    	super().__init__(name, ddl, primary_key, default, index)
         
 # 定义逻辑类型，逻辑类型不能为主键
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
     
 # 定义整形
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index)
    
 # 定义浮点型   
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index)
         
 # 定义文本类型，文本类型不能为主键，使用文本型数据，你可以存放超过二十亿个字符的字符串。当你需要存储大串的字符时，应该使用文本型数据。
 class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+# 定义snowflake主键和外键列：64位整数超过了JavaScript能精确表示的2^53，coroweb输出JSON时把这些列转换为字符串
+class IdField(IntegerField):
+    def __init__(self, name=None, primary_key=False, default=None, index=False):
+        super().__init__(name, primary_key, default, index)
+
+    # 客户端原样传回JSON中的字符串id，转换为整数后才能与查询结果和缓存中的主键对应
+    def convert(self, value):
+        return int(value) if isinstance(value, str) and value.isdigit() else value
+
+# 定义计数列，只由Counter增减，元类生成的__update__不包含它，避免整行更新时覆盖计数
+class CounterField(IntegerField):
+    def __init__(self, name=None):
+        super().__init__(name, False, 0)
+
+# 由元类收集的__mappings__和__indexes__生成建表语句和建索引语句
+def create_table_sql(model):
+    columns = []
+    for k in [model.__primary_key__] + model.__fields__:
+        field = model.__mappings__[k]
+        column = '  `%s` %s' % (field.name or k, field.column_type)
+        # 主键和有默认值的列不允许为空，默认值是常数时写入表结构，这样给已有的表加列时旧的行也有值
+        if field.primary_key or field.default is not None:
+            column = column + ' not null'
+        if isinstance(field.default, (bool, int, float)):
+            column = column + ' default %s' % field.default
+        columns.append(column)
+    columns.append('  primary key (`%s`)' % model.__primary_key__)
+    sql = ['create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (model.__table__, ',\n'.join(columns))]
+    for index in model.__indexes__:
+        sql.append('create index `idx_%s_%s` on `%s` (%s);' % (model.__table__, '_'.join(index), model.__table__,
+            ', '.join(map(lambda f: '`%s`' % f, index))))
+    return '\n'.join(sql)
+
+# 多个Model的建表语句，python3 models.py > schema.sql
+def schema(*models):
+    return '\n\n'.join(map(create_table_sql, models))
+
 # 作用：首先，拦截类的创建，然后，修改类，最后，返回修改后的类
 # 继承继承了type类，类似于int类，type类用于创建类对象，int类用于创建int对象
 class ModelMetaclass(type):
@@ -143,6 +985,9 @@ class ModelMetaclass(type):
     指向将要通过元类创建的类对象即后文中的(User)，类似于self，类的名字，类继承的父类集合()，类的方法集合{}
     attr是指类对象的属性和值，方法名和值(方法名)
     '''
+    # 是否有Model声明了输出JSON时转换为字符串的列，coroweb据此决定序列化时是否要复制Model
+    json_str = False
+
     # 当创建类时自动传入参数
     def __new__(cls, name, bases, attrs): 
         # 不对Model类应用元类，而是对Model的子类应用元类
@@ -197,14 +1042,61 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName # 表名
         attrs['__primary_key__'] = primaryKey # 主键名
         attrs['__fields__'] = fields # 非主键名
+        # 可选的按主键缓存：子类设置__cache_size__(容量)和__cache_ttl__(过期秒数)即开启
+        cacheSize = attrs.get('__cache_size__', None)
+        attrs['__cache__'] = LRUCache(cacheSize, attrs.get('__cache_ttl__', None)) if cacheSize else None
+        # 可选的查询结果缓存：子类设置__query_cache_rows__(缓存的总行数)和__query_cache_ttl__(过期秒数)即开启
+        # findAll和findNumber(以及基于它们的findPage，findAfter)的结果在这个表被写入或过期前有效
+        # 只能知道本进程的写入，多进程部署时其他进程的写入要等过期后才能看到，所以必须设置ttl
+        queryRows = attrs.get('__query_cache_rows__', None)
+        if queryRows and not attrs.get('__query_cache_ttl__', None):
+            raise RuntimeError('__query_cache_ttl__ is required with __query_cache_rows__ for %s' % name)
+        attrs['__query_cache__'] = QueryCache(queryRows, attrs.get('__query_cache_ttl__', None)) if queryRows else None
+        attrs['__loader__'] = None
+        # 紧凑的行类型：按select的列顺序(主键在前)生成的namedtuple，由tuple游标的结果直接构造
+        attrs['__row__'] = collections.namedtuple(name + 'Row', [primaryKey] + fields)
+        # 只查询部分列时的行类型，按列的组合缓存
+        attrs['__rows__'] = dict()
+        # 只更新修改过的列时的update语句，按列的组合缓存
+        attrs['__updates__'] = dict()
+        # findPage的count_ttl缓存的总数
+        attrs['__counts__'] = LRUCache(256)
+        # 索引：index=True的列各建一个索引，__indexes__中的每个tuple建一个组合索引
+        indexes = [(k,) for k, v in mappings.items() if v.index and not v.primary_key]
+        for index in attrs.get('__indexes__', []):
+            for k in index:
+                if k not in mappings:
+                    raise RuntimeError('Index column not found: %s' % k)
+            indexes.append(tuple(index))
+        attrs['__indexes__'] = indexes
+        # 这个表的行增删时要维护的父表计数
+        attrs['__counters__'] = list(attrs.get('__counters__', []))
+        # 整行更新的列，不包含计数列
+        updateFields = [f for f in fields if not isinstance(mappings[f], CounterField)]
+        attrs['__update_fields__'] = updateFields
+        # 输出JSON时转换为字符串的列
+        attrs['__json_str__'] = tuple(k for k, v in mappings.items() if isinstance(v, IdField))
+        if attrs['__json_str__']:
+            ModelMetaclass.json_str = True
         # 构建默认的增删改查sql语句形式，真正的操作在上面封装好的select和excute
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields),
         primaryKey, create_args_string(len(escaped_fields) + 1)) # len(escaped_fields) + 1非主键数加主键数1
         attrs['__update__'] = 'update `%s` set %s where `%s` =?' % (tableName, ', '.join(map(lambda f: '`%s`=?' %
-        (mappings.get(f).name or f),fields)), primaryKey)
+        (mappings.get(f).name or f),updateFields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs) # 返回修改后的类
+        # 预先转换好占位符
+        for k in ('__select__', '__insert__', '__update__', '__delete__'):
+            translate(attrs[k])
+        # findAll，findNumber等按查询形状拼接好的sql
+        attrs['__queries__'] = dict()
+        model = type.__new__(cls, name, bases, attrs)
+        # 可选的合并查询：子类设置__batch_find__ = True后，同一轮事件循环中的find(pk)合并为一次查询
+        if attrs.get('__batch_find__', False):
+            model.__loader__ = BatchLoader(model)
+        if model.__query_cache__ is not None:
+            on_table_write(tableName, model.__query_cache__.clear)
+        return model # 返回修改后的类
 
 '''
 定义ORM所有映射的父类：Model
@@ -215,6 +1107,11 @@ Model从dict继承，拥有字典的所有功能，同时实现特殊方法__get
 实现数据库操作的所有方法，定义为class方法，所有继承自Model都具有数据库操作方法
 '''
 class Model(dict, metaclass=ModelMetaclass):
+    # 用only/defer查询时未加载的列名，实例上用object.__setattr__覆盖，不进入dict
+    _deferred = frozenset()
+    # 是否由数据库中的行构造(或已经save)，这样的实例在_dirty中记录之后被修改过的列
+    _loaded = False
+
     # 创建子类对象前(即__init__前)必定经过了__new__
     def __init__(self, **kw):
         # 调用父类dict初始化
@@ -225,12 +1122,21 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            # 属性访问是同步的，不能在这里查询数据库，提示调用者先await load()
+            if key in self._deferred:
+                raise AttributeError(r"'%s' is deferred, call 'await load()' first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     # 前后有双下划线重写python内置函数
     def __setattr__(self, key, value):
         self[key] = value
 
+    # blog.name = 'x'和blog['name'] = 'x'都经过这里，记录值发生变化的列
+    def __setitem__(self, key, value):
+        if self._loaded and key in self.__mappings__ and (key not in self or dict.__getitem__(self, key) != value):
+            self._dirty.add(key)
+        dict.__setitem__(self, key, value)
+
     # 用于更新和插入操作
     def getValue(self, key):
         #直接调用重写的getattr方法即(__getattr__)
@@ -255,45 +1161,209 @@ class Model(dict, metaclass=ModelMetaclass):
     # 针对于整张表所以需类方法，classmethod修饰的方法需要通过cls参数(即子类对象)传递当前类对象
     @classmethod 
     async def findAll(cls, where=None, args=None, **kw): 
-        # cls指的是Model的子类，可以直接调用attrs的方法和属性
-        sql = [cls.__select__] 
-        if where: # 若where查询条件存在
-            sql.append('where') # 在sql语句中添加where关键字
-            sql.append(where) # 添加where查询条件
-        if args is None:
-            args = []
-        
-        orderBy = kw.get('orderBy', None) # 得到orderBy中的查询条件
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        
+        sql, args = cls._selectSql(where, args, **kw)
+        # compact=True时返回namedtuple的list，比dict子类的实例省一半左右的内存，需要dict时调用row._asdict()
+        if kw.get('compact', False):
+            rs = await cls._cachedSelect(sql, args, aiomysql.Cursor, kw.get('cache', True))
+            return list(map(cls._rowClass(kw.get('only', None), kw.get('defer', None))._make, rs))
+        deferred = cls._project(kw.get('only', None), kw.get('defer', None))[1]
+        # 将args参数列表注入sql语句之后，传递给select函数进行查询并返回查询结果
+        rs = await cls._cachedSelect(sql, args, aiomysql.DictCursor, kw.get('cache', True))
+        # 装订成结果集，构成了一个cls类的列表，其实就是每一条记录对应的类实例
+        return [cls._fromRow(r, deferred) for r in rs] 
+
+    # 与findAll的参数相同，但用服务端游标逐批读取，适合导出、回填整张表：
+    # async for c in Comment.iterAll('blog_id=?', [blog_id]): ...
+    # chunks=True时每次得到一批实例组成的list
+    @classmethod
+    async def iterAll(cls, where=None, args=None, chunk_size=1000, chunks=False, **kw):
+        sql, args = cls._selectSql(where, args, **kw)
+        if kw.get('compact', False):
+            make = cls._rowClass(kw.get('only', None), kw.get('defer', None))._make
+            cursorclass = aiomysql.SSCursor
+        else:
+            deferred = cls._project(kw.get('only', None), kw.get('defer', None))[1]
+            make = lambda r: cls._fromRow(r, deferred)
+            cursorclass = aiomysql.SSDictCursor
+        async for rs in select_iter(sql, args, chunk_size, cursorclass):
+            if chunks:
+                yield list(map(make, rs))
+            else:
+                for r in rs:
+                    yield make(r)
+
+    # 键集(seek)分页：按(key, 主键)排序，从上一页最后一行之后开始取，不再用limit offset扫描并丢弃前面的行
+    # after为上一次返回的游标(或(created_at, id)元组)，返回(本页实例的list, 下一页的游标)，没有下一页时游标为None
+    # 需要(created_at, id)上的索引才能直接定位
+    @classmethod
+    async def findAfter(cls, where=None, args=None, after=None, limit=20, desc=True, key='created_at', **kw):
+        pk = cls.__primary_key__
+        # 游标需要排序列的值，only时也要查出来
+        if kw.get('only', None):
+            kw['only'] = list(kw['only']) + [key]
+        op, order = ('<', 'desc') if desc else ('>', 'asc')
+        conds = ['(%s)' % where] if where else []
+        args = list(args or [])
+        if after:
+            value, last = after if isinstance(after, (tuple, list)) else decode_cursor(after)
+            # 展开写成or，MySQL对(a, b) < (?, ?)这种行比较不一定能用上索引
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (key, op, key, pk, op))
+            args.extend([value, value, last])
+        # 多取一行用来判断是否还有下一页
+        rs = await cls.findAll(' and '.join(conds) or None, args,
+            orderBy='`%s` %s, `%s` %s' % (key, order, pk, order), limit=limit + 1, **kw)
+        if len(rs) <= limit:
+            return rs, None
+        rs = rs[:limit]
+        # compact=True时行是namedtuple，不能按列名下标取值
+        last = rs[-1]._asdict() if kw.get('compact', False) else rs[-1]
+        return rs, encode_cursor(last[key], last[pk])
+
+    # 开启了查询结果缓存时按(sql, args)缓存查询到的行，每次由行构造新的实例；cache=False时直接查询
+    # 事务中要读到本事务未提交的写入，不使用缓存
+    @classmethod
+    async def _cachedSelect(cls, sql, args, cursorclass, cache=True, size=None):
+        query = lambda: select(sql, args, size, cursorclass)
+        if cls.__query_cache__ is None or not cache or in_transaction():
+            return await query()
+        return await cls.__query_cache__.fetch((sql, tuple(args or ()), cursorclass), query)
+
+    # 由查询到的行构造实例，deferred是这一行未加载的列
+    @classmethod
+    def _fromRow(cls, r, deferred=frozenset()):
+        obj = cls(**r)
+        obj._markClean()
+        if deferred:
+            object.__setattr__(obj, '_deferred', deferred)
+        return obj
+
+    # compact=True时的行类型，列与_selectColumns查询的列一一对应
+    @classmethod
+    def _rowClass(cls, only=None, defer=None):
+        columns = cls._project(only, defer)[0]
+        if columns is None:
+            return cls.__row__
+        row = cls.__rows__.get(tuple(columns))
+        if row is None:
+            row = cls.__rows__[tuple(columns)] = collections.namedtuple(cls.__name__ + 'Row', columns)
+        return row
+
+    # 列投影：only只查询列出的列，defer查询除列出的列以外的列，主键总是查询
+    # 返回(要查询的列名list, 未加载的列名frozenset)
+    @classmethod
+    def _project(cls, only=None, defer=None):
+        if not only and not defer:
+            return None, frozenset()
+        return cls._memo(('project', tuple(only or ()), tuple(defer or ())), lambda: cls._buildProject(only, defer))
+
+    @classmethod
+    def _buildProject(cls, only, defer):
+        fields = cls.__fields__
+        for f in list(only or []) + list(defer or []):
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid column for %s: %s' % (cls.__name__, f))
+        if only:
+            fields = [f for f in fields if f in only]
+        if defer:
+            fields = [f for f in fields if f not in defer]
+        return [cls.__primary_key__] + fields, frozenset(cls.__fields__) - frozenset(fields)
+
+    # 按只查询部分列时的select语句，不投影时就是元类生成的__select__
+    @classmethod
+    def _selectColumns(cls, only=None, defer=None):
+        columns = cls._project(only, defer)[0]
+        if columns is None:
+            return cls.__select__
+        return cls._memo(('columns', tuple(columns)),
+            lambda: 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, columns)), cls.__table__))
+
+    # 按查询的形状缓存拼接好的sql：同样形状的查询只拼接一次，参数每次单独传入
+    @classmethod
+    def _memo(cls, shape, build):
+        sql = cls.__queries__.get(shape)
+        if sql is None:
+            sql = build()
+            # where子句中直接拼接了值时形状会不断增多，超过上限后不再缓存
+            if len(cls.__queries__) < 256:
+                cls.__queries__[shape] = sql
+        return sql
+
+    # 分页查询，返回(第page页的实例list, 总数)，page从1开始
+    # 总数和本页的查询同时在两个连接上执行，在connection()/transaction()中时依次在同一个连接上执行
+    # count_ttl秒内相同条件的总数直接使用缓存；approximate=True且没有where时使用information_schema中的估计行数
+    @classmethod
+    async def findPage(cls, where=None, args=None, page=1, size=10, count_ttl=None, approximate=False, **kw):
+        if page < 1 or size < 1:
+            raise ValueError('Invalid page or size: %s, %s' % (page, size))
+        args = list(args) if args else []
+        kw['limit'] = ((page - 1) * size, size)
+        total = None
+        key = (where, tuple(args))
+        if count_ttl:
+            total = cls.__counts__.get(key)
+        if total is None:
+            if approximate and not where:
+                count = select('select `table_rows` _num_ from information_schema.tables where `table_schema`=database() and `table_name`=?', [cls.__table__], 1)
+                count = cls._number(count)
+            else:
+                count = cls.findNumber('count(`%s`)' % cls.__primary_key__, where, args, kw.get('cache', True))
+            total, items = await asyncio.gather(count, cls.findAll(where, args, **kw))
+            total = total or 0
+            if count_ttl:
+                cls.__counts__.set(key, total, count_ttl)
+        elif total > (page - 1) * size:
+            items = await cls.findAll(where, args, **kw)
+        else:
+            # 缓存的总数说明这一页没有数据
+            items = []
+        return items, total
+
+    # 按WHERE，orderBy，limit拼接select语句，返回(sql, args)
+    @classmethod
+    def _selectSql(cls, where=None, args=None, **kw):
+        # 复制一份，不修改调用者传入的args
+        args = list(args) if args else []
         limit = kw.get('limit', None) # 得到limit的查询条件
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
                 # extend() 函数用于在列表末尾一次性追加另一个序列中的多个值（用新列表扩展原来的列表）
                 # 将limit添加进参数列表，之所以添加参数列表之后再进行整合是为了防止sql注入
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        # 将args参数列表注入sql语句之后，传递给select函数进行查询并返回查询结果
-        rs = await select(' '.join(sql), args)  
-        # 装订成结果集，构成了一个cls类的列表，其实就是每一条记录对应的类实例
-        return [cls(**r) for r in rs] 
+        only, defer, orderBy = kw.get('only', None), kw.get('defer', None), kw.get('orderBy', None)
+        # 查询的形状：投影的列，where子句，orderBy，limit的参数个数
+        shape = ('select', tuple(only or ()), tuple(defer or ()), where, orderBy, None if limit is None else isinstance(limit, int))
+        return cls._memo(shape, lambda: cls._buildSelect(where, orderBy, limit, only, defer)), args
+
+    @classmethod
+    def _buildSelect(cls, where, orderBy, limit, only, defer):
+        # cls指的是Model的子类，可以直接调用attrs的方法和属性
+        sql = [cls._selectColumns(only, defer)] 
+        if where: # 若where查询条件存在
+            sql.append('where') # 在sql语句中添加where关键字
+            sql.append(where) # 添加where查询条件
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        if limit is not None:
+            sql.append('limit')
+            sql.append('?' if isinstance(limit, int) else '?, ?')
+        return ' '.join(sql)
     
     # 查询某个字段的数量
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+    async def findNumber(cls, selectField, where=None, args=None, cache=True):
+        sql = cls._memo(('number', selectField, where), lambda: ' '.join(
+            ['select %s _num_ from `%s`' % (selectField, cls.__table__)] + (['where', where] if where else [])))
+        return await cls._number(cls._cachedSelect(sql, args, aiomysql.DictCursor, cache, 1))
+
+    # 取出select ... _num_的结果
+    @staticmethod
+    async def _number(query):
+        rs = await query
         if len(rs) == 0:
             return None
         # rs是结果集dict包含tuple
@@ -301,11 +1371,77 @@ class Model(dict, metaclass=ModelMetaclass):
         
     # 按主键查找对象
     @classmethod
-    async def find(cls, pk): # 实例查询操作
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+    async def find(cls, pk, only=None, defer=None): # 实例查询操作
+        pk = cls.__mappings__[cls.__primary_key__].convert(pk)
+        deferred = cls._project(only, defer)[1]
+        # 交给BatchLoader合并查询，缓存由findMany负责；事务中要读到本事务未提交的写入，不合并
+        if cls.__loader__ is not None and not deferred and not in_transaction():
+            return await cls.__loader__.load(pk)
+        # 开启了缓存则先查缓存，缓存中保存的是行dict，每次返回新的实例以免调用者修改缓存
+        cache = cls._rowCache()
+        if cache is not None:
+            r = cache.get(pk)
+            if r is not None:
+                return cls._fromRow(r)
+        sql = cls._memo(('find', tuple(only or ()), tuple(defer or ())),
+            lambda: '%s where `%s`=?' % (cls._selectColumns(only, defer), cls.__primary_key__))
+        rs = await select(sql, [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        # 缓存中只放完整的行
+        if cache is not None and not deferred:
+            cache.set(pk, rs[0])
+        return cls._fromRow(rs[0], deferred)
+
+    # 按主键批量查找，用一次where pk in (...)查询代替逐个find，返回与pks一一对应的list，不存在的为None
+    @classmethod
+    async def findMany(cls, pks, only=None, defer=None):
+        # 缓存和found的key与查询结果中的主键类型一致
+        pks = list(map(cls.__mappings__[cls.__primary_key__].convert, pks))
+        cache = cls._rowCache()
+        deferred = cls._project(only, defer)[1]
+        found = dict()
+        # 先从缓存中取，只查询缓存中没有的主键
+        if cache is not None:
+            for pk in pks:
+                r = cache.get(pk)
+                if r is not None:
+                    found[pk] = cls._fromRow(r)
+        missing = list(collections.OrderedDict.fromkeys(pk for pk in pks if pk not in found))
+        # 每次最多查询1024个主键，避免sql过长
+        for i in range(0, len(missing), 1024):
+            batch = missing[i:i + 1024]
+            # 用最后一个主键把in列表补齐到2的幂，只有11种长度，不会让_memo和query_stats被各种长度占满
+            size = 1 << (len(batch) - 1).bit_length()
+            batch = batch + batch[-1:] * (size - len(batch))
+            sql = cls._memo(('many', tuple(only or ()), tuple(defer or ()), size),
+                lambda: '%s where `%s` in (%s)' % (cls._selectColumns(only, defer), cls.__primary_key__, create_args_string(size)))
+            rs = await select(sql, batch)
+            for r in rs:
+                if cache is not None and not deferred:
+                    cache.set(r[cls.__primary_key__], r)
+                found[r[cls.__primary_key__]] = cls._fromRow(r, deferred)
+        return [found.get(pk, None) for pk in pks]
+
+    # 按主键的缓存；事务中读到的行可能还未提交(之后可能回滚)，既不从缓存读也不放入缓存
+    @classmethod
+    def _rowCache(cls):
+        return None if in_transaction() else cls.__cache__
+
+    # 加载only/defer查询时未加载的列，names为空时加载全部未加载的列
+    async def load(self, *names):
+        # 按__fields__的顺序拼接列名，同样的列总是得到同样的sql
+        names = [f for f in self.__fields__ if f in self._deferred and (not names or f in names)]
+        if not names:
+            return self
+        sql = self._memo(('load', tuple(names)), lambda: 'select %s from `%s` where `%s`=?' % (
+            ', '.join(map(lambda f: '`%s`' % f, names)), self.__table__, self.__primary_key__))
+        rs = await select(sql, [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise ValueError('Record not found: %s' % self.getValue(self.__primary_key__))
+        dict.update(self, rs[0])
+        object.__setattr__(self, '_deferred', self._deferred - frozenset(names))
+        return self
         
     async def save(self): # 实例插入操作
         # 将__fields__保存的除主键外的所有属性一次传递到getValueOrDefault函数中获取值
@@ -313,22 +1449,98 @@ class Model(dict, metaclass=ModelMetaclass):
         # 增加主键名
         args.append(self.getValueOrDefault(self.__primary_key__))
         # 执行插入语句
-        rows = await execute(self.__insert__, args)
+        rows = await self._writeCounted(self.__insert__, args, 1)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
-    
+        self._markClean()
+        self._invalidate()
+
+    # 批量插入，rows中可以是Model实例或dict，复用元类生成的__insert__语句，返回每一批影响的行数
+    @classmethod
+    async def saveMany(cls, rows, batch_size=1000):
+        args_list = []
+        for row in rows:
+            # dict先转换为实例，才能用getValueOrDefault填充默认值(如主键next_id)
+            if not isinstance(row, cls):
+                row = cls(**row)
+            args = list(map(row.getValueOrDefault, cls.__fields__))
+            args.append(row.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+        if not args_list:
+            return []
+        if not cls.__counters__:
+            counts = await execute_many(cls.__insert__, args_list, batch_size)
+        else:
+            # 同一个父表行的计数合并为一次更新
+            async with transaction():
+                counts = await execute_many(cls.__insert__, args_list, batch_size)
+                for counter in cls.__counters__:
+                    i = cls.__fields__.index(counter.foreign_key)
+                    for pk, n in collections.Counter(args[i] for args in args_list).items():
+                        await counter.incr(pk, n)
+        if sum(counts) != len(args_list):
+            logging.warn('failed to insert records: expected rows: %s, affected rows: %s' % (len(args_list), counts))
+        return counts
+
     async def update(self): # 实例更新操作
-        args = list(map(self.getValue, self.__fields__))
+        sql, fields = self.__update__, self.__update_fields__
+        # 从数据库加载的实例只更新修改过的列(未加载的列不会被修改)，没有修改则不必访问数据库
+        if self._loaded:
+            fields = [f for f in fields if f in self._dirty]
+            if not fields:
+                return
+            sql = self._updateSql(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        self._markClean()
+        self._invalidate()
+
+    # 只更新fields这些列的update语句，按列的组合缓存在__updates__中
+    @classmethod
+    def _updateSql(cls, fields):
+        key = tuple(fields)
+        sql = cls.__updates__.get(key)
+        if sql is None:
+            sql = cls.__updates__[key] = 'update `%s` set %s where `%s`=?' % (cls.__table__,
+                ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), fields)), cls.__primary_key__)
+        return sql
+
+    # 实例与数据库中的行一致：之后的修改记录在_dirty中
+    def _markClean(self):
+        object.__setattr__(self, '_loaded', True)
+        object.__setattr__(self, '_dirty', set())
             
     async def remove(self): # 实例删除操作
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await self._writeCounted(self.__delete__, args, -1)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        self._invalidate()
+
+    # 执行insert(n=1)或delete(n=-1)，有__counters__时在同一事务中更新父表的计数
+    async def _writeCounted(self, sql, args, n):
+        if not self.__counters__:
+            return await execute(sql, args)
+        async with transaction():
+            rows = await execute(sql, args)
+            if rows == 1:
+                for counter in self.__counters__:
+                    await counter.incr(self.getValue(counter.foreign_key), n)
+        return rows
+
+    # 用count(*)重新计算这个表维护的所有父表计数
+    @classmethod
+    async def reconcileCounters(cls):
+        for counter in cls.__counters__:
+            await counter.reconcile(cls)
+
+    # 写操作后使该主键的缓存失效，下次find重新从数据库读取
+    def _invalidate(self):
+        if self.__cache__ is not None:
+            self.__cache__.pop(self.getValue(self.__primary_key__))
 
 '''test            
 if __name__ == '__main__':